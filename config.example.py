@@ -4,6 +4,11 @@
 config = {
     # the classical --verbose switch
     'debug': True,
+    # 'threads' (default): one thread for each protocol and pipeline worker
+    # 'asyncio': run the bus and protocols in one event loop
+    'runtime': 'threads',
+    # optional, executor sizes for the 'asyncio' runtime
+    'asyncio': {'command': 4, 'io': 8},
     # status file
     # for example can record the last Telegram API offset
     # filename (in JSON format) or ':SQLite3:'
@@ -22,11 +27,39 @@ config = {
     'command_config': {
         'autoclose': False,
         # whether the bot should send a welcome message when a user joined the group
-        'welcome': True
+        'welcome': True,
+        # whether an unambiguous prefix of a command name runs the command
+        'prefix_match': False,
+        # seconds a command or general handler may wait for external
+        # commands before replying "Command timed out." (None: no limit)
+        'timeout': 30,
+        # overrides for commands ('/name') or general handlers ('name')
+        'timeouts': {'/py': 10, '/reply': 15}
     },
     # can have SQLite3 and Plain Text formats
+    # a logger can be configured with a filename or a dict of options
     'loggers': {
+        # 'sqlite': {'filename': 'chatlogv2.db', 'writer': True,
+        #            'batch_size': 100, 'batch_time': 500,
+        #            # messages waiting for the writer before logging blocks
+        #            'queue_size': 10000,
+        #            # full-text index for /search, needs SQLite 3.34+ with FTS5
+        #            'fts': True,
+        #            # read-only connections for commands, used with 'writer'
+        #            'readers': 4,
+        #            # cache sizes, and users of the last N messages to load
+        #            'msg_cache': 1000, 'user_cache': 20000, 'preload': 1000,
+        #            # store media compressed (older rows stay readable,
+        #            # the compact_media maintenance task converts them)
+        #            'compress_media': False,
+        #            # attach <name>.archive-*.db made by the archive_messages
+        #            # maintenance task
+        #            'archives': True},
         'sqlite': 'chatlogv2.db',
+        # append-only segment files in a directory, lookups by id and time
+        # only; the export_seglog maintenance task converts it to SQLite
+        # 'seglog': {'path': 'chatlog.seg', 'segment_size': 67108864,
+        #            'time_step': 256, 'compress_media': False},
         'textlog': 'chatlog.txt'
     },
     # which of the following protocols should be mainly relied on
@@ -72,6 +105,8 @@ config = {
             # can ignore some users when relaying messages
             # None or list of ids like [123, 456]
             'ignored_user': None,
+            # optional, concurrent downloads of media files to the pastebin
+            'media_workers': 4,
         },
         'telegramcli': {
             # optional 'enabled' field for all protocols, default True
@@ -91,6 +126,29 @@ config = {
             ]
         }
     },
+    # optional, workers and queue size of each message handling stage
+    # policy: 'block' waits for the queue (backpressure), 'drop' discards
+    'pipeline': {
+        'ingest': {'workers': 1, 'maxsize': 1000, 'policy': 'block'},
+        'log': {'workers': 1, 'maxsize': 5000, 'policy': 'block'},
+        'command': {'workers': 3, 'maxsize': 1000, 'policy': 'drop'},
+        # each destination protocol has its own ordered lane with one worker
+        'lane': {'maxsize': 1000, 'policy': 'block'},
+    },
+    # optional, when to commit the loggers and the status store:
+    # after `idle` seconds without messages, but at least every `max_delay`
+    # and at most every `min_interval` seconds;
+    # idle commits are followed by incremental vacuum and WAL checkpoints,
+    # at most every `maintain_interval` seconds
+    'commit': {'idle': 60, 'min_interval': 5, 'max_delay': 300,
+               'maintain_interval': 600},
+    # optional, drop messages posted again within `ttl` seconds, such as
+    # updates delivered twice, and messages the `proxies` bots repeat
+    # within `relay_ttl` seconds, such as our own forwards bounced back;
+    # remember at most `maxsize` (0 to disable)
+    'dedup': {'ttl': 600, 'relay_ttl': 60, 'maxsize': 10000},
+    # optional, log latency statistics of the message path every N seconds
+    'metrics': {'log_interval': None},
     # forward messages between these protocols
     'forward': ['irc', 'telegrambot', 'http', 'skype'],
     'services': {
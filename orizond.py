@@ -9,7 +9,11 @@ from orizonhub import base
 
 logging.basicConfig(stream=sys.stderr, format='%(asctime)s [%(levelname).1s:%(name).8s] %(message)s', level=logging.DEBUG if config['debug'] else logging.INFO)
 
-bot = base.BotInstance(config)
+if config.get('runtime') == 'asyncio':
+    from orizonhub import aio
+    bot = aio.AsyncBotInstance(config)
+else:
+    bot = base.BotInstance(config)
 
 try:
     bot.start()
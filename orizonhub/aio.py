@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+asyncio runtime.
+
+The message bus, and protocols that provide a `start_async` coroutine,
+run in one event loop. Blocking work goes to explicit executors:
+'db' for loggers, 'command' for commands, and the default executor of
+the loop ('io') for protocol calls. Protocols with only `start_polling`
+run in their own thread through `run_in_thread`.
+'''
+
+import time
+import asyncio
+import logging
+import threading
+import functools
+import collections
+import concurrent.futures
+
+from .base import BotInstance
+from .consumer import Stage, MessageHandler
+
+logger = logging.getLogger('aio')
+
+class AsyncStage(Stage):
+    '''
+    A pipeline stage whose workers are coroutines in the event loop.
+    Tasks run in `executor`, or directly in the loop if it is None.
+    '''
+
+    def __init__(self, name, workers, maxsize, policy, loop, executor=None):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.loop = loop
+        self.executor = executor
+        self.queue = asyncio.Queue(maxsize)
+        # (item, waiter) that found the queue full, in submission order
+        self.overflow = collections.deque()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.done = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.wait_time = 0
+        self.max_wait = 0
+        self.run_time = 0
+        self.threads = [asyncio.run_coroutine_threadsafe(self._worker(), loop)
+                        for n in range(workers)]
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def submit(self, fn, *args, **kwargs):
+        fut = concurrent.futures.Future()
+        item = (fut, fn, args, kwargs, time.monotonic())
+        if self._in_loop():
+            self._put_nowait(item)
+        elif self.policy == 'drop' or not self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._put_nowait, item)
+        else:
+            # backpressure for threads
+            asyncio.run_coroutine_threadsafe(self._put(item), self.loop).result()
+        return fut
+
+    def _put_nowait(self, item):
+        if self.overflow or self.queue.full():
+            if self.policy == 'drop':
+                with self.lock:
+                    self.dropped += 1
+                logger.warning('Stage %s is full, task dropped.', self.name)
+                item[0].set_result(None)
+                return
+            # we can't block the loop, so keep the order in the overflow
+            self._overflow(item, None)
+            return
+        self.queue.put_nowait(item)
+        with self.lock:
+            self.submitted += 1
+
+    async def _put(self, item):
+        if not self.overflow and not self.queue.full():
+            self.queue.put_nowait(item)
+            with self.lock:
+                self.submitted += 1
+            return
+        waiter = self.loop.create_future()
+        self._overflow(item, waiter)
+        await waiter
+
+    def _overflow(self, item, waiter):
+        with self.lock:
+            self.blocked += 1
+        self.overflow.append((item, waiter))
+        if len(self.overflow) == 1:
+            self.loop.create_task(self._drain())
+
+    async def _drain(self):
+        # the only task that moves items from the overflow into the queue
+        while self.overflow:
+            item, waiter = self.overflow[0]
+            await self.queue.put(item)
+            self.overflow.popleft()
+            with self.lock:
+                self.submitted += 1
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+    async def _worker(self):
+        while 1:
+            item = await self.queue.get()
+            if item is None:
+                break
+            fut, fn, args, kwargs, queued = item
+            start = time.monotonic()
+            if fut.set_running_or_notify_cancel():
+                try:
+                    if asyncio.iscoroutinefunction(fn):
+                        result = await fn(*args, **kwargs)
+                    elif self.executor is None:
+                        result = fn(*args, **kwargs)
+                    else:
+                        result = await self.loop.run_in_executor(
+                            self.executor, functools.partial(fn, *args, **kwargs))
+                    fut.set_result(result)
+                except BaseException as ex:
+                    fut.set_exception(ex)
+            end = time.monotonic()
+            with self.lock:
+                self.done += 1
+                self.wait_time += start - queued
+                self.max_wait = max(self.max_wait, start - queued)
+                self.run_time += end - start
+
+    def status(self):
+        st = super().status()
+        st['overflow'] = len(self.overflow)
+        return st
+
+    async def _stop(self):
+        # let the overflow in before the workers are stopped
+        while self.overflow:
+            await asyncio.sleep(0.05)
+        for t in self.threads:
+            await self.queue.put(None)
+        await asyncio.gather(*(asyncio.wrap_future(t) for t in self.threads))
+
+    def shutdown(self):
+        if self.loop.is_closed():
+            return
+        elif self._in_loop():
+            for t in self.threads:
+                self.queue.put_nowait(None)
+        elif self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+        else:
+            self.loop.run_until_complete(self._stop())
+
+class AsyncMessageHandler(MessageHandler):
+    # which executor the stage runs tasks in, None means in the loop
+    EXECUTORS = {
+        'ingest': None,
+        'log': 'db',
+        'command': 'command'
+    }
+
+    def __init__(self, config, protocols, loggers, loop):
+        self.loop = loop
+        cfg = config.get('asyncio') or {}
+        self.executors = {
+            'db': concurrent.futures.ThreadPoolExecutor(1, 'db'),
+            'command': concurrent.futures.ThreadPoolExecutor(
+                cfg.get('command', 4), 'command'),
+            'io': concurrent.futures.ThreadPoolExecutor(cfg.get('io', 8), 'io')
+        }
+        loop.set_default_executor(self.executors['io'])
+        super().__init__(config, protocols, loggers)
+
+    def make_stage(self, name, workers, maxsize, policy):
+        # lanes run protocol calls
+        executor = self.EXECUTORS.get(name, 'io')
+        return AsyncStage(name, workers, maxsize, policy, self.loop,
+                          executor and self.executors[executor])
+
+    def close(self):
+        super().close()
+        for executor in self.executors.values():
+            executor.shutdown()
+
+def run_in_thread(func, name, loop):
+    '''
+    Adapter for thread-based protocols. Runs `func` in a daemon thread and
+    returns an asyncio future that is done when the thread exits.
+    '''
+    fut = loop.create_future()
+
+    def _done(ex):
+        if fut.done():
+            pass
+        elif ex is None:
+            fut.set_result(None)
+        else:
+            fut.set_exception(ex)
+
+    def _run():
+        ex = None
+        try:
+            func()
+        except BaseException as e:
+            ex = e
+        loop.call_soon_threadsafe(_done, ex)
+
+    t = threading.Thread(target=_run, name=name)
+    t.daemon = True
+    t.start()
+    return fut
+
+class AsyncBotInstance(BotInstance):
+    def make_handler(self):
+        self.loop = asyncio.new_event_loop()
+        # protocol tasks or futures
+        self.tasks = []
+        self.main_task = None
+        return AsyncMessageHandler(self.config, self.protocols, self.loggers, self.loop)
+
+    def start(self):
+        if not self.setup():
+            return
+        asyncio.set_event_loop(self.loop)
+        self.main_task = self.loop.create_task(self.main())
+        try:
+            self.loop.run_until_complete(self.main_task)
+        except KeyboardInterrupt:
+            logging.warning('SIGINT received.')
+
+    async def main(self):
+        supervised = []
+        for k, p in self.load_protocols():
+            if hasattr(p, 'start_async'):
+                fut = self.loop.create_task(p.start_async())
+                logging.info('Started protocol: %s (asyncio)', k)
+            else:
+                fut = run_in_thread(p.start_polling, k, self.loop)
+                logging.info('Started protocol: %s (thread)', k)
+            self.tasks.append(fut)
+            supervised.append(self._supervise(k, fut))
+        logging.info('Satellite launched.')
+        await asyncio.gather(*supervised)
+
+    @staticmethod
+    async def _supervise(name, fut):
+        try:
+            await fut
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception('Protocol %s stopped.', name)
+
+    def exit(self):
+        for v in self.protocols.values():
+            v.close()
+        for t in self.tasks:
+            t.cancel()
+        if self.main_task and not self.main_task.done():
+            self.loop.run_until_complete(self.main_task)
+        super().exit()
+        self.loop.close()
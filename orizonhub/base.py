@@ -21,27 +21,25 @@ class BotInstance:
         self.loggers = {}
         self.threads = []
 
-        self.bus = MessageBus(MessageHandler(config, self.protocols, self.loggers))
+        self.bus = MessageBus(self.make_handler())
         self.bus.timezone = self.timezone
         logging.info('Bot instance initialized.')
 
-    def start(self):
+    def make_handler(self):
+        return MessageHandler(self.config, self.protocols, self.loggers)
+
+    def setup(self):
+        '''
+        Set up services, loggers and commands.
+        Returns False if the bot should not launch.
+        '''
         services = self.config.services
         if services.pastebin == 'self':
             self.bus.pastebin = provider.SimplePasteBin(services.cachepath, services.get('maxsize', 1048576), services.mediaurl)
         elif services.pastebin == 'vim-cn':
             self.bus.pastebin = provider.Elimage(services.cachepath, services.get('maxsize', 1048576))
-        for k, v in self.config.loggers.items():
-            try:
-                self.loggers[k] = provider.loggers[k](v, self.timezone)
-                logging.info('Registered logger: ' + k)
-            except KeyError:
-                raise ValueError('unrecognized logger: ' + k)
-        if self.config.status == ':SQLite3:':
-            self.bus.handler.state = provider.SQLiteStateStore(
-                self.loggers['sqlite'].conn, self.loggers['sqlite'].lock)
-        else:
-            self.bus.handler.state = provider.BasicStateStore(self.config.status)
+        # before the loggers open, so that they see the archives and
+        # settings the tasks made
         if self.config.get('maintenance') and self.config.maintenance.get('enabled'):
             from . import maintenance
             for task in self.config.maintenance.tasks:
@@ -52,21 +50,52 @@ class BotInstance:
             logging.info('Maintenance done.')
             if not self.config.maintenance.get('continue'):
                 logging.info("Satellite won't launch.")
-                return
+                return False
+        for k, v in self.config.loggers.items():
+            try:
+                if isinstance(v, dict):
+                    self.loggers[k] = provider.loggers[k](tz=self.timezone, **v)
+                else:
+                    self.loggers[k] = provider.loggers[k](v, self.timezone)
+                logging.info('Registered logger: ' + k)
+            except KeyError:
+                raise ValueError('unrecognized logger: ' + k)
+        if self.config.status == ':SQLite3:':
+            sqlite = self.loggers['sqlite']
+            self.bus.handler.state = provider.SQLiteStateStore(
+                sqlite.conn, sqlite.lock, None if sqlite.filename == ':memory:'
+                else sqlite.filename + '-state')
+        else:
+            self.bus.handler.state = provider.BasicStateStore(self.config.status)
         provider.command.activate(self.bus, self.config)
+        return True
+
+    def load_protocols(self):
+        '''
+        Instantiate enabled protocols. Returns a list of (name, protocol).
+        '''
+        loaded = []
         for k, v in self.config.protocols.items():
             try:
                 if v.get('enabled', True):
                     p = self.protocols[k] = provider.protocols[k](self.config, self.bus)
                     for proxy in v.get('proxies') or ():
                         self.protocols[proxy[0]] = p
-                    t = threading.Thread(target=p.start_polling, name=k)
-                    t.daemon = True
-                    t.start()
-                    logging.info('Started protocol: ' + k)
-                    self.threads.append(t)
+                    loaded.append((k, p))
             except KeyError:
-                raise ValueError('unrecognized protocol: ' + v)
+                raise ValueError('unrecognized protocol: ' + k)
+        provider.command.rebuild()
+        return loaded
+
+    def start(self):
+        if not self.setup():
+            return
+        for k, p in self.load_protocols():
+            t = threading.Thread(target=p.start_polling, name=k)
+            t.daemon = True
+            t.start()
+            logging.info('Started protocol: ' + k)
+            self.threads.append(t)
         logging.info('Satellite launched.')
         try:
             for t in self.threads:
@@ -89,8 +118,8 @@ class MessageBus:
         self.pastebin = provider.DummyPasteBin()
         self.timezone = None
 
-    def post(self, msg):
-        return self.handler(msg)
+    def post(self, msg, received=None):
+        return self.handler(msg, received=received)
 
     def post_sync(self, msg):
         return self.handler(msg, False).result()
@@ -7,8 +7,14 @@ PREFIX = "/'"
 
 commands = support.cp.commands
 general_handlers = support.cp.general_handlers
+routes = support.cp.routes
 activate = support.cp.activate
+rebuild = support.cp.rebuild
 close = support.cp.close
+call = support.cp.call
+budget = support.cp.budget
+stats = support.cp.stats
+CommandTimeout = support.CommandTimeout
 
 from . import simple
 from . import msglog
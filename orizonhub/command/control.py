@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import threading
+
 from ..model import User
 from ..utils import nt_from_dict
 from .support import cp, logger
 
+# held while a backup started by /_cmd backup runs
+backup_lock = threading.Lock()
+
+def _run_backup(filename):
+    try:
+        cp.bus.sqlite.backup(filename)
+    finally:
+        backup_lock.release()
+
 @cp.register_command('autoclose', mtype=('group',))
 def cmd_autoclose(expr, msg=None):
     if msg:
@@ -26,6 +39,68 @@ def cmd__cmd(expr, msg=None):
             v.commit()
         logger.info('DB committed upon user request.')
         return 'DB committed.'
+    elif expr == 'pipeline':
+        lines = ['%s: %s/%s queued, %s done, %s dropped, %s blocked, '
+            'wait %.3fs (max %.3fs), run %.3fs' % (
+            name, st['qsize'], st['maxsize'] or '∞', st['done'],
+            st['dropped'], st['blocked'], st['avg_wait'], st['max_wait'],
+            st['avg_time'])
+            for name, st in cp.bus.handler.pipeline_status().items()]
+        st = cp.bus.handler.dedup.status()
+        lines.append('dedup: %s suppressed, %s tracked' % (
+            st['suppressed'], st['tracked']))
+        st = cp.bus.handler.committer.status()
+        if st['last_commit']:
+            lines.append('commit: %ds ago, took %.3fs' % (
+                time.time() - st['last_commit'], st['last_duration']))
+        return '\n'.join(lines)
+    elif expr == 'stats':
+        return '\n'.join(cp.bus.handler.metrics.format()) or 'No data.'
+    elif expr == 'caches':
+        return '\n'.join('%s: %s/%s, %s hits, %s misses, %s evictions' % (
+            name, st['size'], st['maxsize'], st['hits'], st['misses'],
+            st['evictions']) for name, st in
+            cp.bus.sqlite.cache_status().items())
+    elif expr == 'commands':
+        with cp.stats_lock:
+            stats = sorted(cp.stats.items(), key=lambda x: -x[1]['time'])
+        return '\n'.join('%s: %d calls, %d timeouts, %d errors, %.3fs' % (
+            name, st['calls'], st['timeouts'], st['errors'], st['time'])
+            for name, st in stats) or 'No data.'
+    elif expr == 'backup':
+        # taken here, so that a second call can't start another one
+        # before the thread runs
+        if not backup_lock.acquire(False):
+            return 'Backup in progress.'
+        filename = '%s.backup-%s.db' % (
+            os.path.splitext(cp.bus.sqlite.filename)[0],
+            time.strftime('%Y%m%d%H%M%S'))
+        thread = threading.Thread(target=_run_backup,
+                                  args=(filename,), name='backup')
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            backup_lock.release()
+            raise
+        return 'Backup started: ' + filename
+    elif expr == 'maintenance':
+        lines = []
+        st = cp.bus.sqlite.maint_status.get('backup')
+        if st:
+            lines.append('backup: %s, %s, %s/%s pages left, %d steps '
+                '(%d retried, max %.3fs), %ds' % (
+                st['filename'], 'failed' if st.get('error') else
+                'done' if st['finished'] else 'running', st['remaining'],
+                st['total'], st['steps'], st['retries'], st['max_step'],
+                (st['finished'] or time.time()) - st['started']))
+        st = cp.bus.sqlite.maint_status.get('maintain')
+        if st:
+            lines.append('idle: %ds ago, %d pages freed, %s frames '
+                'checkpointed, %d steps (max %.3fs)' % (
+                time.time() - st['time'], st['freed'], st['checkpointed'],
+                st['steps'], st['max_step']))
+        return '\n'.join(lines) or 'No data.'
     elif expr == 'raiseex':  # For debug
         raise Exception('/_cmd raiseex')
     #else:
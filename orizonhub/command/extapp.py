@@ -165,7 +165,10 @@ def sql_auth(sqltype, arg1, arg2, dbname, source):
 
 def cmd_query(expr):
     try:
-        conn = sqlite3.connect(os.path.join(root_path, main_config['loggers']['sqlite']))
+        dbfile = main_config['loggers']['sqlite']
+        if isinstance(dbfile, dict):
+            dbfile = dbfile['filename']
+        conn = sqlite3.connect(os.path.join(root_path, dbfile))
         conn.set_authorizer(sql_auth)
         cur = conn.cursor()
         cur.execute(expr)
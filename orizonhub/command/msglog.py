@@ -46,7 +46,7 @@ def cmd_getmsg(expr, msg=None):
             return 'Message ID: %d' % msg.reply.id
         else:
             return 'Syntax error. Usage: ' + cmd_getmsg.__doc__
-    messages = list(filter(None, (cp.bus.sqlite.getmsg(mid) for mid in mids)))
+    messages = list(filter(None, cp.bus.sqlite.getmsgs(mids)))
     if len(messages) == 1:
         return forward_tgbot(msg, messages[0])
     else:
@@ -65,7 +65,7 @@ def cmd_context(expr, msg=None):
             mid, limit = int(expr[0]), 2
     except Exception:
         return 'Syntax error. Usage: ' + cmd_context.__doc__
-    messages = list(filter(None, (cp.bus.sqlite.getmsg(mid) for mid in range(mid - limit, mid + limit + 1))))
+    messages = list(filter(None, cp.bus.sqlite.getmsgs(range(mid - limit, mid + limit + 1))))
     return Response(forwardmulti_text(messages),
             {'type': 'forward', 'messages': messages}, msg, None)
 
@@ -74,14 +74,13 @@ def cmd_quote(expr, msg=None):
     '''/quote Send a today's random message.'''
     #cp.bus.status(msg.chat, 'typing')
     sec = daystart()
-    mid = cp.bus.sqlite.select('SELECT id FROM messages WHERE time >= ? AND time < ? ORDER BY RANDOM() LIMIT 1', (sec, sec + 86400)).fetchone()
+    mid = cp.bus.sqlite.sample(sec, sec + 86400)
     if mid is None:
-        mid = cp.bus.sqlite.select('SELECT id FROM messages ORDER BY RANDOM() LIMIT 1').fetchone()
-    fwd = cp.bus.sqlite.getmsg(mid[0])
+        mid = cp.bus.sqlite.sample()
+    fwd = cp.bus.sqlite.getmsg(mid)
     return forward_tgbot(msg, fwd)
 
-@cp.register_command('search', mtype=('private', 'group'), dependency='sqlite')
-@cp.register_command('s', mtype=('private', 'group'), dependency='sqlite')
+@cp.register_command('search', mtype=('private', 'group'), dependency='sqlite', aliases=('s',))
 def cmd_search(expr, msg=None):
     '''/search|/s [@username] [keyword] [number=5|number,offset] Search the group log for recent messages. max(number)=20'''
     username, uid, limit, offset = None, None, 5, 0
@@ -104,9 +103,7 @@ def cmd_search(expr, msg=None):
         uid = db_getuidbyname(username)
     if uid is None:
         keyword = ' '.join(expr)
-        sqr = cp.bus.sqlite.select("SELECT id, src, text, time FROM messages WHERE text LIKE ? ORDER BY time DESC LIMIT ? OFFSET ?", ('%' + keyword + '%', limit, offset)).fetchall()
-    else:
-        sqr = cp.bus.sqlite.select("SELECT id, src, text, time FROM messages WHERE src = ? AND text LIKE ? ORDER BY time DESC LIMIT ? OFFSET ?", (uid, '%' + keyword + '%', limit, offset)).fetchall()
+    sqr = cp.bus.sqlite.search(keyword, uid, limit, offset)
     result = []
     for mid, fr, text, mtime in sqr:
         text = ellipsisresult(text, keyword)
@@ -123,22 +120,19 @@ def cmd_mention(expr, msg=None):
     '''/mention [offset] Show last mention of you.'''
     if not msg:
         return "This command can't be used in this chat."
-    offset = ''
+    offset = 0
     if expr:
         try:
-            offset = ' OFFSET %d' % max(int(expr.strip()) - 1, 0)
+            offset = max(int(expr.strip()) - 1, 0)
         except ValueError:
             pass
     user = cp.bus.sqlite.update_user(msg.src)
-    if user.username:
-        res = cp.bus.sqlite.select("SELECT id, protocol, pid FROM messages WHERE (text LIKE ? OR reply_id IN (SELECT pid FROM messages WHERE src = ?)) AND src != ? AND src != ? ORDER BY time DESC LIMIT 1" + offset, ('%@' + user.username + '%', user.id, user.id, cp.bus.telegrambot.identity.id)).fetchone()
-        userat = '@' + user.username + ' '
-    else:
-        res = cp.bus.sqlite.select("SELECT id, protocol, pid FROM messages WHERE reply_id IN (SELECT pid FROM messages WHERE src = ?) AND src != ? AND src != ? ORDER BY time DESC LIMIT 1" + offset, (user.id, user.id, cp.bus.telegrambot.identity.id)).fetchone()
-        userat = ''
-    if res:
-        msgid, msgproto, msgpid = res
-        referred = cp.bus.sqlite.getmsg(msgid)
+    userat = '@' + user.username + ' ' if user.username else ''
+    msgid = cp.bus.sqlite.mention(user.id, offset,
+                                  (cp.bus.telegrambot.identity.id,))
+    referred = msgid and cp.bus.sqlite.getmsg(msgid)
+    if referred:
+        msgproto, msgpid = referred.protocol, referred.pid
         if msgproto.startswith('telegram'):
             text = userat + 'You were mentioned in this message.'
             try:
@@ -160,8 +154,9 @@ def cmd_history(expr, msg=None):
         return 'Please select a message and reply.'
     elif msg.reply.pid is None:
         return 'Message history is not available.'
-    mids = [row[0] for row in cp.bus.sqlite.select("SELECT id FROM messages WHERE protocol=? AND pid=? ORDER BY time ASC", (msg.reply.protocol, msg.reply.pid))]
-    messages = list(filter(None, (cp.bus.sqlite.getmsg(mid) for mid in mids)))
+    with cp.bus.sqlite.reader() as conn:
+        mids = [row[0] for row in conn.execute("SELECT id FROM all_messages WHERE protocol=? AND pid=? ORDER BY time ASC", (msg.reply.protocol, msg.reply.pid))]
+    messages = list(filter(None, cp.bus.sqlite.getmsgs(mids)))
     text = []
     for m in messages:
         text.append('[%s] %s' % (formattime(m.time), m.text))
@@ -212,7 +207,7 @@ def cmd_uinfo(expr, msg=None):
         uinfoln.append('ID: %s' % user.pid)
     result = [', '.join(uinfoln)]
     if msg.mtype == 'group':
-        r = cp.bus.sqlite.select('SELECT DISTINCT src, count(src) FROM messages WHERE time > ? GROUP BY src', (time.time() - minutes * 60,)).fetchall()
+        r = cp.bus.sqlite.activity(time.time() - minutes * 60)
         timestr = timestring(minutes)
         if r:
             ctr = dict(r)
@@ -234,7 +229,7 @@ def cmd_stat(expr, msg=None):
     except Exception:
         minutes = 1440
     # TODO: group by alias
-    r = cp.bus.sqlite.select('SELECT DISTINCT src, count(src) FROM messages WHERE time > ? GROUP BY src', (time.time() - minutes * 60,)).fetchall()
+    r = cp.bus.sqlite.activity(time.time() - minutes * 60)
     timestr = timestring(minutes)
     if not r:
         return '在最近%s内无消息。' % timestr
@@ -257,11 +252,13 @@ def db_getuidbyname(username):
             pid = int(username[1:])
         except ValueError:
             return None
-        uid = cp.bus.sqlite.select('SELECT id FROM users WHERE pid = ?', (pid,)).fetchone()
+        with cp.bus.sqlite.reader() as conn:
+            uid = conn.execute('SELECT id FROM users WHERE pid = ?', (pid,)).fetchone()
         if uid:
             return uid[0]
     else:
-        uid = cp.bus.sqlite.select('SELECT id FROM users WHERE username LIKE ?', (username,)).fetchone()
+        with cp.bus.sqlite.reader() as conn:
+            uid = conn.execute('SELECT id FROM users WHERE username LIKE ?', (username,)).fetchone()
         if uid:
             return uid[0]
 
@@ -78,6 +78,9 @@ def cmd_reply(expr, msg=None):
     text = ''
     if msg.reply:
         text = msg.reply.text
-    text = (expr.strip() or text or ' '.join(t[0] for t in cp.bus.sqlite.select("SELECT text FROM messages ORDER BY time DESC LIMIT 2").fetchall())).replace('\n', ' ')
+    if not (expr.strip() or text):
+        with cp.bus.sqlite.reader() as conn:
+            text = ' '.join(t[0] for t in conn.execute("SELECT text FROM messages ORDER BY time DESC LIMIT 2"))
+    text = (expr.strip() or text).replace('\n', ' ')
     return cp.external('reply', text).result()
 
@@ -113,26 +113,20 @@ def cmd_hello(expr, msg=None):
 @cp.register_command('help')
 def cmd_help(expr, msg=None):
     '''/help [command] List available commands or show help for some command.'''
-    # TODO
+    protocol, mtype = (msg.protocol, msg.mtype) if msg else (None, None)
+    commands = cp.routes.route(protocol, mtype)[0]
     if expr:
-        if expr in cp.commands:
-            h = cp.commands[expr].usage
-            if h:
-                return h
-            else:
-                return 'Help is not available for ' + expr
-        else:
+        # aliases and prefixes resolve as they do when running commands
+        name = cp.routes.resolve(expr.strip().lstrip('/'), protocol, mtype)
+        if name is None:
             return 'Command not found.'
-    elif msg.mtype == 'private' and msg.protocol != 'irc':
-        return '\n'.join(uniq(cmd.usage for cmdname, cmd in cp.commands.items() if
-                cmd.usage and not (
-                cmd.protocol and msg.protocol not in cmd.protocol
-                or cmd.mtype and msg.mtype not in cmd.mtype
-                or cmd.dependency and cmd.dependency not in cp.bus.handler.providers)))
+        h = commands[name].usage
+        if h:
+            return h
+        else:
+            return 'Help is not available for ' + expr
+    if msg.mtype == 'private' and msg.protocol != 'irc':
+        return '\n'.join(uniq(cmd.usage for cmdname, cmd in commands.items() if cmd.usage))
     else:
         return 'Commands: %s. For usage: /help [cmd]' % ', '.join(uniq(
-            '/' + cmdname for cmdname, cmd in cp.commands.items() if not (
-                cmd.protocol and msg.protocol not in cmd.protocol
-                or cmd.mtype and msg.mtype not in cmd.mtype
-                or cmd.dependency and cmd.dependency not in cp.bus.handler.providers)
-        ))
+            '/' + cmdname for cmdname in commands))
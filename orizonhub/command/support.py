@@ -4,6 +4,7 @@
 import os
 import time
 import json
+import bisect
 import logging
 import resource
 import threading
@@ -15,30 +16,168 @@ from ..model import Message, Command, Response
 
 logger = logging.getLogger('cmd')
 
+class CommandTimeout(Exception):
+    pass
+
+class RoutingTable:
+    '''
+    Maps (protocol, mtype) to the commands and general handlers that
+    qualify, so dispatching doesn't check every filter for every message.
+    Routes are computed on first use and dropped by `rebuild`.
+    '''
+
+    def __init__(self, commands, general_handlers, aliases):
+        self.commands = commands
+        self.general_handlers = general_handlers
+        self.aliases = aliases
+        self.providers = frozenset()
+        self.prefix_match = False
+        self.routes = {}
+
+    def rebuild(self, providers=None, prefix_match=None):
+        if providers is not None:
+            self.providers = frozenset(providers)
+        if prefix_match is not None:
+            self.prefix_match = prefix_match
+        self.routes = {}
+
+    def _qualify(self, c, protocol, mtype):
+        # protocol is None for requests without a message
+        return not (protocol is None and (c.protocol or c.mtype)
+                    or c.protocol and protocol not in c.protocol
+                    or c.mtype and mtype not in c.mtype
+                    or c.dependency and c.dependency not in self.providers)
+
+    def route(self, protocol, mtype):
+        '''
+        Returns (commands, sorted command names, general handlers).
+        '''
+        key = (protocol, mtype)
+        r = self.routes.get(key)
+        if r is None:
+            commands = collections.OrderedDict(
+                (k, c) for k, c in self.commands.items()
+                if self._qualify(c, protocol, mtype))
+            handlers = tuple((k, gh) for k, gh in self.general_handlers.items()
+                             if self._qualify(gh, protocol, mtype))
+            r = self.routes[key] = (commands, sorted(commands), handlers)
+        return r
+
+    def resolve(self, name, protocol, mtype):
+        '''
+        Returns the real name of a command, alias or prefix, or None.
+        '''
+        commands, names, handlers = self.route(protocol, mtype)
+        name = self.aliases.get(name, name)
+        if name in commands:
+            return name
+        elif self.prefix_match and name:
+            # only match an unambiguous prefix
+            i = bisect.bisect_left(names, name)
+            if (i < len(names) and names[i].startswith(name) and not
+                (i + 1 < len(names) and names[i + 1].startswith(name))):
+                return names[i]
+
+    def handlers(self, protocol, mtype):
+        return self.route(protocol, mtype)[2]
+
 class CommandProvider:
     def __init__(self):
         self.bus = None
         self.config = None
-        self.external = ExternalCommandProvider()
+        self.external = ExternalCommandProvider(self.remaining)
         self.general_handlers = collections.OrderedDict()
         self.commands = collections.OrderedDict()
+        self.aliases = {}
+        self.routes = RoutingTable(self.commands, self.general_handlers, self.aliases)
+        # deadline of the command running in each thread
+        self.local = threading.local()
+        # '/command' or 'handler': {'calls', 'timeouts', 'errors', 'time'}
+        self.stats = collections.OrderedDict()
+        self.stats_lock = threading.Lock()
 
     def activate(self, bus, config):
         self.bus = bus
         self.config = config
         self.external.start()
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+        Rebuild the routing table. Call this when providers change.
+        '''
+        if self.bus is None:
+            self.routes.rebuild()
+        else:
+            self.routes.rebuild(self.bus.handler.providers,
+                self.config.get('command_config', {}).get('prefix_match', False))
+
+    def budget(self, key):
+        '''
+        Returns the time budget in seconds of a command ('/name') or general
+        handler ('name'), or None for no limit.
+        '''
+        cfg = self.config.get('command_config', {}) if self.config else {}
+        return (cfg.get('timeouts') or {}).get(key, cfg.get('timeout', 30))
+
+    def remaining(self):
+        '''
+        Returns the seconds left for the command running in this thread,
+        or None if there is no limit.
+        '''
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def call(self, key, budget, func, *args, **kwargs):
+        '''
+        Call a command or general handler within `budget` seconds and record
+        statistics under `key`. Waiting for an external command raises
+        CommandTimeout after the budget runs out.
+        '''
+        start = time.monotonic()
+        prev = getattr(self.local, 'deadline', None)
+        deadline = start + budget if budget else None
+        if prev is not None and (deadline is None or prev < deadline):
+            deadline = prev
+        self.local.deadline = deadline
+        result = 'errors'
+        try:
+            ret = func(*args, **kwargs)
+            result = None
+            return ret
+        except CommandTimeout:
+            result = 'timeouts'
+            raise
+        finally:
+            self.local.deadline = prev
+            elapsed = time.monotonic() - start
+            with self.stats_lock:
+                st = self.stats.get(key)
+                if st is None:
+                    st = self.stats[key] = {
+                        'calls': 0, 'timeouts': 0, 'errors': 0, 'time': 0}
+                st['calls'] += 1
+                st['time'] += elapsed
+                if result:
+                    st[result] += 1
 
     def register_handler(self, name, protocol=None, mtype=None, dependency=None, enabled=True):
         def wrapper(func):
             if enabled:
                 self.general_handlers[name] = Command(func, func.__doc__, protocol, mtype, dependency)
+                self.rebuild()
             return func
         return wrapper
 
-    def register_command(self, name, protocol=None, mtype=None, dependency=None, enabled=True):
+    def register_command(self, name, protocol=None, mtype=None, dependency=None, enabled=True, aliases=()):
         def wrapper(func):
             if enabled:
                 self.commands[name] = Command(func, func.__doc__, protocol, mtype, dependency)
+                for alias in aliases:
+                    self.aliases[alias] = name
+                self.rebuild()
             return func
         return wrapper
 
@@ -68,6 +207,27 @@ class ExternalCommand:
             resource.setrlimit(resource.RLIMIT_NPROC, (1024, 1024))
         return _setlimits
 
+class ExternalFuture(concurrent.futures.Future):
+    '''
+    Waits no longer than the budget of the calling command, and cancels
+    itself when the budget runs out.
+    '''
+
+    def __init__(self, remaining):
+        super().__init__()
+        self.remaining = remaining
+
+    def result(self, timeout=None):
+        if timeout is None:
+            timeout = self.remaining()
+        try:
+            return super().result(timeout)
+        except concurrent.futures.TimeoutError:
+            if self.cancel():
+                raise CommandTimeout()
+            # finished in the meantime
+            return super().result()
+
 class ExternalCommandProvider:
     '''
     This class implements the old way of running resource-intensive commands
@@ -76,7 +236,8 @@ class ExternalCommandProvider:
     DIR = os.path.dirname(__file__)
     CMD = ('python3', os.path.join(DIR, 'extapp.py'))
 
-    def __init__(self):
+    def __init__(self, remaining=lambda: None):
+        self.remaining = remaining
         self.proc = None
         self.lock = threading.Lock()
         self.task = {}
@@ -99,7 +260,9 @@ class ExternalCommandProvider:
             # Prevent float problems
             tid = str(time.perf_counter())
             text = json.dumps({"cmd": cmd, "args": args, "id": tid})
-            fut = self.task[tid] = concurrent.futures.Future()
+            fut = self.task[tid] = ExternalFuture(self.remaining)
+            # cancelled futures don't wait for their results
+            fut.add_done_callback(lambda f: self.task.pop(tid, None))
             try:
                 self.proc.stdin.write(text.strip().encode('utf-8') + b'\n')
                 self.proc.stdin.flush()
@@ -120,16 +283,17 @@ class ExternalCommandProvider:
             if result:
                 logging.debug('Got from extapp: ' + result)
                 obj = json.loads(result)
-                fut = self.task.get(obj['id'])
+                fut = self.task.pop(obj['id'], None)
                 if fut:
-                    if obj['exc']:
+                    if not fut.set_running_or_notify_cancel():
+                        logging.debug('Task cancelled, result: %r' % obj)
+                    elif obj['exc']:
                         fut.set_exception(Exception(obj['exc']))
                         logging.error('Remote app server error.\n' + obj['exc'])
                     else:
                         fut.set_result(obj['ret']) # or 'Empty.'
-                    del self.task[obj['id']]
                 else:
-                    logging.error('Task not found, result: %r' % obj)
+                    logging.info('Task cancelled or not found, result: %r' % obj)
             time.sleep(0.2)
 
     def restart(self):
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import time
+import queue
 import logging
 import threading
 import collections
@@ -10,12 +12,299 @@ import concurrent.futures
 import pytz
 
 from .model import Message, User, Request, Response
-from .utils import nt_repr
+from .utils import nt_repr, smartname
+from .metrics import Metrics
 from .provider import command
 
 logger = logging.getLogger('handler')
 
+re_ircfmt = re.compile('[\x02\x1D\x1F\x16\x0F\x06]|\x03(?:\d+(?:,\d+)?)?')
+# a forwarded message as it is sent to IRC: "[name] text"
+re_relayed = re.compile(r'^\[([^\]]+)\] (.*)$', re.S)
+
+class Stage:
+    '''
+    A step in the message pipeline, with its own workers and bounded queue.
+
+    When the queue is full, `policy` decides what to do:
+    'block' waits for a free slot (backpressure), 'drop' discards the task.
+    '''
+
+    def __init__(self, name, workers=1, maxsize=0, policy='block'):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.done = 0
+        self.dropped = 0
+        self.blocked = 0
+        # seconds spent in queue and in execution
+        self.wait_time = 0
+        self.max_wait = 0
+        self.run_time = 0
+        self.threads = []
+        for n in range(workers):
+            t = threading.Thread(target=self._worker, name='%s-%d' % (name, n))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        fut = concurrent.futures.Future()
+        item = (fut, fn, args, kwargs, time.monotonic())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == 'drop':
+                with self.lock:
+                    self.dropped += 1
+                logger.warning('Stage %s is full, task dropped.', self.name)
+                fut.set_result(None)
+                return fut
+            with self.lock:
+                self.blocked += 1
+            self.queue.put(item)
+        with self.lock:
+            self.submitted += 1
+        return fut
+
+    def _worker(self):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            fut, fn, args, kwargs, queued = item
+            start = time.monotonic()
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(fn(*args, **kwargs))
+                except BaseException as ex:
+                    fut.set_exception(ex)
+            end = time.monotonic()
+            with self.lock:
+                self.done += 1
+                self.wait_time += start - queued
+                self.max_wait = max(self.max_wait, start - queued)
+                self.run_time += end - start
+
+    def status(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'maxsize': self.maxsize,
+                'qsize': self.queue.qsize(),
+                'submitted': self.submitted,
+                'done': self.done,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'avg_wait': self.wait_time / self.done if self.done else 0,
+                'max_wait': self.max_wait,
+                'avg_time': self.run_time / self.done if self.done else 0
+            }
+
+    def shutdown(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+class CommitScheduler:
+    '''
+    Calls `func` in one long-lived thread after messages arrive.
+
+    Commits happen when no message arrived for `idle` seconds, but at least
+    every `max_delay` seconds under continuous load and at most every
+    `min_interval` seconds.
+
+    After a commit in an idle period, `idle_func(busy)` is called at most
+    every `maintain_interval` seconds. It should stop when `busy()`.
+    '''
+
+    def __init__(self, func, idle=60, min_interval=5, max_delay=300,
+                 idle_func=None, maintain_interval=600):
+        self.func = func
+        self.idle = idle
+        self.min_interval = min_interval
+        self.max_delay = max_delay
+        self.idle_func = idle_func
+        self.maintain_interval = maintain_interval
+        self.last_maintain_mono = 0
+        self.cond = threading.Condition()
+        self.run = True
+        # monotonic times
+        self.dirty_since = None
+        self.last_touch = 0
+        self.last_commit_mono = 0
+        # wall clock time of the last commit and how long it took
+        self.last_commit = None
+        self.last_duration = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name='committer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def touch(self):
+        with self.cond:
+            self.last_touch = time.monotonic()
+            if self.dirty_since is None:
+                self.dirty_since = self.last_touch
+                self.cond.notify()
+
+    def _due(self):
+        # returns seconds to wait, or 0 if a commit is due now
+        if self.dirty_since is None:
+            return None
+        now = time.monotonic()
+        due = min(self.last_touch + self.idle, self.dirty_since + self.max_delay)
+        due = max(due, self.last_commit_mono + self.min_interval)
+        return max(due - now, 0)
+
+    def _loop(self):
+        while 1:
+            with self.cond:
+                wait = self._due()
+                while self.run and wait != 0:
+                    self.cond.wait(wait)
+                    wait = self._due()
+                if not self.run:
+                    break
+                self.dirty_since = None
+            self.commit()
+            now = time.monotonic()
+            if (self.idle_func and now - self.last_touch >= self.idle and
+                now - self.last_maintain_mono >= self.maintain_interval):
+                self.last_maintain_mono = now
+                try:
+                    self.idle_func(self.busy)
+                except Exception:
+                    logger.exception('Idle maintenance failed.')
+
+    def commit(self):
+        start = time.monotonic()
+        try:
+            self.func()
+        except Exception:
+            logger.exception('Failed to commit.')
+        self.last_commit_mono = time.monotonic()
+        self.last_duration = self.last_commit_mono - start
+        self.last_commit = time.time()
+
+    def busy(self):
+        '''Whether messages arrived since the last commit, or stopping.'''
+        return self.dirty_since is not None or not self.run
+
+    def stop(self):
+        with self.cond:
+            self.run = False
+            self.cond.notify()
+
+    def status(self):
+        return {
+            'last_commit': self.last_commit,
+            'last_duration': self.last_duration,
+            'pending': self.dirty_since is not None
+        }
+
+class DedupIndex:
+    '''
+    Remembers recently posted messages for `ttl` seconds, keeping at most
+    `maxsize` of them, to suppress re-delivered updates.
+
+    Messages with a protocol message id are keyed on (chat, pid, edit_date)
+    and the text. Relay bots (protocols in `relays`) repeat messages of
+    other networks, sometimes our own forwards; those are keyed on the
+    sender name and text only, as `relay_key` strips them, and dropped if
+    any group message had the same key within `relay_ttl` seconds. Other
+    messages without an id, such as repeats in IRC, are kept.
+    '''
+
+    def __init__(self, ttl=600, maxsize=10000, relays=(), relay_ttl=60):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.relays = frozenset(relays)
+        self.relay_ttl = relay_ttl
+        self.lock = threading.Lock()
+        # key: monotonic expiry time, in insertion order
+        self.seen = collections.OrderedDict()
+        self.suppressed = 0
+
+    def key(self, msg):
+        '''Returns the key of `msg` by its id, or None if it has none.'''
+        if msg.pid is not None:
+            chat = msg.chat._key() if msg.chat else None
+            # the text tells apart edits within the same second
+            return hash((msg.protocol, chat, msg.pid,
+                         msg.media and msg.media.get('edit_date'), msg.text))
+
+    @staticmethod
+    def relay_key(msg):
+        '''
+        Returns the key of `msg` by its sender name and text, which stay
+        the same when a relay bot repeats it, or None.
+        '''
+        text = re_ircfmt.sub('', msg.text or '').strip()
+        if not text:
+            return None
+        name = smartname(msg.src) if msg.src else ''
+        # our own forward, with the original sender in the prefix
+        match = re_relayed.match(text)
+        if match:
+            name, text = match.groups()
+        return hash(('relay', name.strip().casefold(), text.strip()))
+
+    def check(self, msg):
+        '''
+        Returns True if `msg` was seen before, otherwise records it.
+        '''
+        if not self.maxsize:
+            return False
+        ttl, rkey = self.ttl, None
+        key = self.key(msg)
+        if key is not None:
+            # in case a relay repeats it
+            if msg.mtype == 'group':
+                rkey = self.relay_key(msg)
+        elif msg.protocol in self.relays:
+            key, ttl = self.relay_key(msg), self.relay_ttl
+        elif msg.mtype == 'group':
+            # only remembered, a repeat in IRC is kept
+            rkey = self.relay_key(msg)
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen
+            while seen:
+                k, expiry = next(iter(seen.items()))
+                if expiry > now:
+                    break
+                del seen[k]
+            # entries with a shorter ttl may stay behind older ones
+            if key is not None and seen.get(key, 0) > now:
+                self.suppressed += 1
+                return True
+            for k, t in ((key, ttl), (rkey, self.relay_ttl)):
+                if k is not None:
+                    seen.pop(k, None)
+                    seen[k] = now + t
+            while len(seen) > self.maxsize:
+                seen.popitem(last=False)
+        return False
+
+    def status(self):
+        return {'suppressed': self.suppressed, 'tracked': len(self.seen)}
+
 class MessageHandler:
+    # name: (workers, maxsize, policy)
+    STAGES = collections.OrderedDict((
+        ('ingest', (1, 1000, 'block')),
+        ('log', (1, 5000, 'block')),
+        ('command', (3, 1000, 'drop')),
+    ))
+
     def __init__(self, config, protocols, loggers):
         # logger.setLevel(logging.DEBUG if config.debug else logging.INFO)
         self.config = config
@@ -23,44 +312,67 @@ class MessageHandler:
         self.loggers = loggers
         self.providers = collections.ChainMap(self.protocols, self.loggers)
         self.state = {}
-        self.commit_task = None
-        self.executor = concurrent.futures.ThreadPoolExecutor(5)
+        self.committer = CommitScheduler(self.commit, idle_func=self.maintain,
+                                         **(config.get('commit') or {}))
+        self.committer.start()
+        self.stages = collections.OrderedDict()
+        stagecfg = config.get('pipeline') or {}
+        for name, default in self.STAGES.items():
+            workers, maxsize, policy = default
+            cfg = stagecfg.get(name) or {}
+            self.stages[name] = self.make_stage(name, cfg.get('workers', workers),
+                cfg.get('maxsize', maxsize), cfg.get('policy', policy))
+        # one ordered lane per destination protocol for forward() and send()
+        self.lanecfg = stagecfg.get('lane') or {}
+        self.lanes = collections.OrderedDict()
+        self.lanes_lock = threading.Lock()
         self.timezone = pytz.timezone(config.timezone)
         self.usernames = set(p.username for p in config.protocols.values()
                              if 'username' in p)
         self.messagettl = 120
+        self.metrics = Metrics(**(config.get('metrics') or {}))
+        self.dedup = DedupIndex(relays=set(p[0] for v in config.protocols.values()
+            for p in v.get('proxies') or ()), **(config.get('dedup') or {}))
 
-    def process(self, msg):
+    def process(self, msg, trace=None):
+        '''
+        Send the message to the log and forward stages.
+        Returns the submitted tasks and a command job (func, args) or None.
+        '''
         #logger.debug(nt_repr(msg))
         now = time.time()
         tasks = {}
         logger.info('Message: ' + msg.text)
         if isinstance(msg, Request):
-            return tasks, self.dispatch(msg)
+            return tasks, (self.dispatch, (msg,))
         else:
             self.delayed_commit()
             if msg.mtype == 'group':
                 for n, l in self.loggers.items():
-                    tasks[n] = self.submit_task(l.log, msg)
+                    tasks[n] = self.submit_task('log',
+                        self._traced(trace, 'logged', l.log), msg)
                 if self.messagettl + (
                     msg.media and msg.media.get('edit_date') or msg.time) > now:
                     for n in self.config.forward:
                         if n != msg.protocol and n in self.protocols:
-                            tasks[n] = self.submit_task(
-                                self.protocols[n].forward, msg, n)
+                            tasks[n] = self.submit_task(self.lane(n),
+                                self._traced(trace, 'forwarded',
+                                self.protocols[n].forward), msg, n)
+                            if trace:
+                                trace.mark('forward_submitted')
             if self.messagettl + msg.time > now:
                 req = self.parse_cmd(msg.text) if msg.text and (
                         not msg.media or 'edit_date' not in msg.media) else None
                 if req:
                     logger.debug('parsed request: %s', req)
-                    return tasks, self.dispatch(req, msg)
+                    return tasks, (self.dispatch, (req, msg))
                 else:
-                    return tasks, self.dispatch_gh(msg)
+                    return tasks, (self.dispatch_gh, (msg,))
             else:
                 logger.debug('ignored old message(%s): %s', msg.time, msg.text)
         return tasks, None
 
-    def respond(self, res, processed={}):
+    def respond(self, res, processed={}, trace=None):
         # res.reply must be Message
         proxied = {r.protocol:r for r in res.proxied_reply} if res.proxied_reply else {}
         if res.reply.mtype == 'group':
@@ -68,34 +380,112 @@ class MessageHandler:
                 if n in proxied:
                     if n == self.config.main_protocol:
                         for loggername, l in self.loggers.items():
-                            self.submit_task(l.log, proxied[n])
+                            self.submit_task('log', l.log, proxied[n])
                 elif n == self.config.main_protocol:
-                    fut = self.submit_task(p.send, res, n, processed[n].result() if n in processed else None)
+                    fut = self.submit_task(self.lane(n),
+                        self._traced(trace, 'responded', self._send),
+                        p, res, n, processed.get(n))
                     fut.add_done_callback(self._resp_log_cb)
                 else:
-                    self.submit_task(p.send, res, n, processed[n].result() if n in processed else None)
+                    self.submit_task(self.lane(n),
+                        self._traced(trace, 'responded', self._send),
+                        p, res, n, processed.get(n))
         elif res.reply.protocol not in proxied:
             pn = res.reply.protocol
-            self.submit_task(self.protocols[pn].send, res, pn, None)
+            self.submit_task(self.lane(pn),
+                self._traced(trace, 'responded', self._send),
+                self.protocols[pn], res, pn, None)
+
+    @staticmethod
+    def _traced(trace, point, fn):
+        return trace.wrap(point, fn) if trace else fn
+
+    @staticmethod
+    def _send(p, res, protocol, forwarded):
+        # the forwarded message went through the same lane before
+        return p.send(res, protocol, forwarded.result() if forwarded else None)
+
+    def make_stage(self, name, workers, maxsize, policy):
+        return Stage(name, workers, maxsize, policy)
+
+    def lane(self, name):
+        '''
+        Get the lane of a destination. Proxied protocols share the lane
+        of the real protocol.
+        '''
+        p = self.protocols[name]
+        with self.lanes_lock:
+            lane = self.lanes.get(p)
+            if lane is None:
+                lane = self.lanes[p] = self.make_stage('lane:' + name, 1,
+                    self.lanecfg.get('maxsize', 1000),
+                    self.lanecfg.get('policy', 'block'))
+            return lane
+
+    def __call__(self, msg, respond=True, received=None):
+        '''
+        Post a message. `received` is the monotonic time when the protocol
+        received the message.
+        '''
+        fut = concurrent.futures.Future()
+        if isinstance(msg, Message) and self.dedup.check(msg):
+            logger.debug('duplicate message: %s', nt_repr(msg))
+            fut.set_result(None)
+            return fut
+        trace = self.metrics.trace(received)
+        self.stages['ingest'].submit(self._ingest, msg, respond, fut, trace
+            ).add_done_callback(self._chain(fut))
+        return fut
 
-    def __call__(self, msg, respond=True):
-        def _do_process(msg, respond):
+    @staticmethod
+    def _chain(fut):
+        def callback(f):
+            # the task was dropped or failed before taking care of `fut`
+            if f.cancelled() or f.exception() or not f.result():
+                fut.set_result(None)
+        return callback
+
+    def _ingest(self, msg, respond, fut, trace=None):
+        try:
+            tasks, job = self.process(msg, trace)
+        except Exception:
+            logger.exception('Failed to process a message: %s', msg)
+            job = None
+        if job:
+            self.stages['command'].submit(self._command, job, tasks, respond,
+                fut, trace).add_done_callback(self._chain(fut))
+        else:
+            fut.set_result(None)
+        return True
+
+    def _command(self, job, tasks, respond, fut, trace=None):
+        func, args = job
+        try:
+            r = func(*args)
+        except Exception:
+            logger.exception('Failed to execute: %s', args)
+            r = None
+        if respond and r:
             try:
-                tasks, r = self.process(msg)
+                self.respond(r, tasks, trace)
             except Exception:
-                logger.exception('Failed to process a message: %s', msg)
-            if respond and r:
-                try:
-                    self.respond(r, tasks)
-                except Exception:
-                    logger.exception('Failed to respond to a message: %s', r)
-            else:
-                return r
-        return self.executor.submit(_do_process, msg, respond)
+                logger.exception('Failed to respond to a message: %s', r)
+            r = None
+        fut.set_result(r)
+        return True
 
     def status(self, dest: User, action: str):
+        # in the lane, so that it is sent before the response
         for n, p in self.protocols.items():
-            self.submit_task(p.status, dest, action)
+            self.submit_task(self.lane(n), p.status, dest, action)
+
+    def pipeline_status(self):
+        ret = collections.OrderedDict(
+            (name, s.status()) for name, s in self.stages.items())
+        with self.lanes_lock:
+            for lane in self.lanes.values():
+                ret[lane.name] = lane.status()
+        return ret
 
     def _resp_log_cb(self, fut):
         msg = fut.result()
@@ -103,7 +493,7 @@ class MessageHandler:
             logger.warning('%s.send() returned None', self.config.main_protocol)
             return
         for n, l in self.loggers.items():
-            self.submit_task(l.log, msg)
+            self.submit_task('log', l.log, msg)
 
     def parse_cmd(self, text: str):
         t = text.strip().replace('\xa0', ' ').split(' ', 1)
@@ -118,21 +508,24 @@ class MessageHandler:
         return Request(cmd[0][1:], expr, {})
 
     def dispatch(self, req: Request, msg=None):
-        c = command.commands.get(req.cmd)
-        logger.debug('command: %s', c)
-        if not (c is None
-                or msg is None and c.protocol
-                or c.protocol and msg.protocol not in c.protocol
-                or c.mtype and msg.mtype not in c.mtype
-                or c.dependency and c.dependency not in self.providers
-            ):
+        if msg is None:
+            name = command.routes.resolve(req.cmd, None, None)
+        else:
+            name = command.routes.resolve(req.cmd, msg.protocol, msg.mtype)
+        logger.debug('command: %s', name)
+        if name is not None:
+            c = command.commands[name]
             if msg:
                 req.kwargs['msg'] = msg
             elif 'msg' in req.kwargs:
                 # no fake messages
                 del req.kwargs['msg']
             try:
-                r = c.func(req.expr, **req.kwargs)
+                r = command.call('/' + name, command.budget('/' + name),
+                                 c.func, req.expr, **req.kwargs)
+            except command.CommandTimeout:
+                logger.warning('Command timed out: %s', req)
+                r = 'Command timed out.'
             except Exception:
                 logger.exception('Failed to execute: %s', req)
                 return None
@@ -146,42 +539,52 @@ class MessageHandler:
         '''
         Dispatch general handlers. Only return the first answer.
         '''
-        for ghname, gh in command.general_handlers.items():
-            if not (gh.protocol and msg.protocol not in gh.protocol
-                    or gh.mtype and msg.mtype not in gh.mtype
-                    or gh.dependency and gh.dependency not in self.providers):
-                try:
-                    r = gh.func(msg)
-                except Exception:
-                    logger.exception('Failed to execute general handler: %s, %s', ghname, msg)
-                    continue
-                if r:
-                    if not isinstance(r, Response):
-                        r = Response(r, None, msg, None)
-                    return r
-
-    def submit_task(self, fn, *args, **kwargs):
+        for ghname, gh in command.routes.handlers(msg.protocol, msg.mtype):
+            try:
+                r = command.call(ghname, command.budget(ghname), gh.func, msg)
+            except command.CommandTimeout:
+                logger.warning('General handler timed out: %s, %s', ghname, msg)
+                continue
+            except Exception:
+                logger.exception('Failed to execute general handler: %s, %s', ghname, msg)
+                continue
+            if r:
+                if not isinstance(r, Response):
+                    r = Response(r, None, msg, None)
+                return r
+
+    def submit_task(self, stage, fn, *args, **kwargs):
         def func_noerr(*args, **kwargs):
             try:
                 return fn(*args, **kwargs)
             except Exception:
                 logger.exception('Async function failed.')
-        return self.executor.submit(func_noerr, *args, **kwargs)
+        if isinstance(stage, str):
+            stage = self.stages[stage]
+        return stage.submit(func_noerr, *args, **kwargs)
 
-    def delayed_commit(self, delay=60):
-        if self.commit_task:
-            self.commit_task.cancel()
-        self.commit_task = threading.Timer(delay, self.commit)
-        self.commit_task.start()
+    def delayed_commit(self):
+        self.committer.touch()
 
     def commit(self):
         for l in self.loggers.values():
             l.commit()
         self.state.commit()
 
+    def maintain(self, stop=None):
+        for l in self.loggers.values():
+            if stop and stop():
+                break
+            l.maintain(stop)
+
     def close(self):
-        if self.commit_task:
-            self.commit_task.cancel()
+        self.committer.stop()
+        # stop producers before consumers
+        for name in ('ingest', 'command'):
+            self.stages[name].shutdown()
+        with self.lanes_lock:
+            for lane in self.lanes.values():
+                lane.shutdown()
+        self.stages['log'].shutdown()
         if self.state:
             self.state.close()
-        self.executor.shutdown()
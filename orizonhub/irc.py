@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 import re
+import ssl
 import time
 import queue
+import asyncio
 import logging
 from zlib import crc32
 
@@ -67,6 +69,11 @@ class IRCProtocol(Protocol):
         self.cfg = config.protocols.irc
         self.bus = bus
         self.ircconn = None
+        # asyncio streams and their loop, used by start_async
+        self.reader = self.writer = None
+        self.loop = None
+        # PINGs sent without hearing from the server
+        self.pings = 0
         self.run = True
         self.forward_enabled = True
         self.ready = False
@@ -118,59 +125,7 @@ class IRCProtocol(Protocol):
             except Exception:
                 logger.exception('Failed to poll from IRC.')
                 continue
-            mtime = int(time.time())
-            if line:
-                logger.debug('IRC: %s', line)
-            if not line:
-                pass
-            elif line["cmd"] == "JOIN" and line["nick"] == self.cfg.username:
-                channelname = line['dest'] or line['msg']
-                logger.info('I joined IRC channel: %s' % channelname)
-                if channelname == self.cfg.channel:
-                    self.ready = True
-                else:
-                    self.ircconn.part(channelname, 'not my channel')
-                    self.ircconn.join(self.cfg.channel)
-            elif line["cmd"] == "PART" and line["nick"] == self.cfg.username:
-                channelname = line['dest'] or line['msg']
-                logger.info('I left IRC channel: %s' % channelname)
-            elif line["cmd"] == "PRIVMSG":
-                # ignored users
-                if self.cfg.ignored_user and re.match(self.cfg.ignored_user, line["nick"]):
-                    continue
-                if line["dest"] == self.cfg.username:
-                    mtype = 'private'
-                    src = dest = self._make_user(line["nick"])
-                elif line["dest"] == self.cfg.channel:
-                    mtype = 'group'
-                    src = self._make_user(line["nick"])
-                    dest = self.dest
-                else:
-                    continue
-                # should use /whois and cache to get realname?
-                protocol = 'irc'
-                action = re_ircaction.match(line["msg"])
-                if action:
-                    text = action.group(1).strip()
-                    media = {'action': True}
-                else:
-                    text = line["msg"].strip()
-                    media = None
-                # OrzTox bot have actions and quotes
-                for p, val in self.proxies.items():
-                    n, m = val
-                    if n.match(line["nick"]):
-                        mt = m.match(text)
-                        if mt:
-                            protocol = p
-                            src = self._make_user(mt.group(1), p)
-                            text = mt.group(2)
-                        break
-                alttext = self.identify_mention(re_ircfmt.sub('', text))
-                self.bus.post(Message(
-                    None, protocol, None, src, dest, text, media, mtime,
-                    None, None, None, mtype, None if alttext == text else alttext
-                ))
+            self.process_line(line)
             wait = self.rate - time.perf_counter() + last_sent
             if wait > self.poll_rate or not self.ready:
                 time.sleep(self.poll_rate)
@@ -189,6 +144,178 @@ class IRCProtocol(Protocol):
                     logger.exception('Failed to send to IRC.')
                     last_sent = time.perf_counter()
 
+    async def start_async(self):
+        '''
+        Coroutine version of start_polling for the asyncio runtime.
+        '''
+        loop = self.loop = asyncio.get_event_loop()
+        sender = loop.create_task(self._send_async())
+        try:
+            while self.run:
+                try:
+                    await self._connect_async()
+                except Exception:
+                    logger.exception('Failed to connect to IRC.')
+                    await asyncio.sleep(self.poll_rate)
+                    continue
+                try:
+                    raw = await asyncio.wait_for(self.reader.readline(), 300)
+                except asyncio.TimeoutError:
+                    # like the threaded path: two PINGs, then reconnect
+                    if self.pings < 2:
+                        self.pings += 1
+                        self.ircconn.quote('PING %s' % self.ircconn.nick, sendnow=False)
+                        self._flush_async()
+                    else:
+                        logger.warning('IRC connection timed out.')
+                        self._disconnect_async()
+                    continue
+                except Exception:
+                    logger.exception('Failed to poll from IRC.')
+                    self._disconnect_async()
+                    continue
+                if not raw:
+                    if self.run:
+                        logger.warning('IRC connection closed.')
+                    self._disconnect_async()
+                    continue
+                self.pings = 0
+                # the connection has no socket, so the replies parse()
+                # sends itself are lost; send them through the writer
+                line = self.ircconn.parse(line=raw.rstrip(b'\r\n').decode('utf-8', 'replace'))
+                if not line:
+                    pass
+                elif line['cmd'] == 'PING':
+                    self.ircconn.quote('PONG :%s' % line['msg'], sendnow=False)
+                    self._flush_async()
+                elif (line['cmd'] == 'PRIVMSG' and line['nick']
+                      and (line['msg'] or '').startswith('\x01PING ')):
+                    # CTCP PING
+                    self.ircconn.notice(line['nick'], line['msg'], sendnow=False)
+                    self._flush_async()
+                self.process_line(line)
+        finally:
+            sender.cancel()
+
+    async def _connect_async(self):
+        if self.writer is not None:
+            return
+        self.ready = False
+        self.reader, self.writer = await asyncio.open_connection(
+            self.cfg.server, self.cfg.port,
+            ssl=ssl.create_default_context() if self.cfg.ssl else None)
+        self.ircconn = IRCConnection()
+        self.ircconn.addr = (self.cfg.server, self.cfg.port)
+        if self.cfg.get('password'):
+            self.ircconn.setpass(self.cfg.password, sendnow=False)
+        self.ircconn.setnick(self.cfg.username, sendnow=False)
+        self.ircconn.setuser(self.cfg.get('ident'), self.cfg.get('realname'), sendnow=False)
+        self.ircconn.join(self.cfg.channel, sendnow=False)
+        self._flush_async()
+        logger.info('IRC connected.')
+
+    def flush(self):
+        if self.writer is not None:
+            self._flush_async()
+        else:
+            self.ircconn.send()
+
+    def _flush_async(self):
+        if self.writer is not None and self.ircconn.sendbuf:
+            self.writer.write(self.ircconn.sendbuf)
+            self.ircconn.sendbuf = b''
+
+    def _disconnect_async(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        self.ready = False
+        self.pings = 0
+
+    def _quit_async(self):
+        if self.writer is not None:
+            self.ircconn.quote('QUIT :SIGINT received', sendnow=False)
+            self._flush_async()
+            self._disconnect_async()
+
+    async def _send_async(self):
+        last_sent = 0
+        while self.run:
+            wait = self.rate - time.perf_counter() + last_sent
+            if wait > self.poll_rate or not self.ready:
+                await asyncio.sleep(self.poll_rate)
+                continue
+            try:
+                prio, args = self.send_q.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(self.poll_rate)
+                continue
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self.writer is None:
+                self.send_q.put((prio, args))
+                continue
+            self.ircconn.say(*args, sendnow=False)
+            self._flush_async()
+            last_sent = time.perf_counter()
+
+    def process_line(self, line):
+        received = time.monotonic()
+        mtime = int(time.time())
+        if line:
+            logger.debug('IRC: %s', line)
+        if not line:
+            pass
+        elif line["cmd"] == "JOIN" and line["nick"] == self.cfg.username:
+            channelname = line['dest'] or line['msg']
+            logger.info('I joined IRC channel: %s' % channelname)
+            if channelname == self.cfg.channel:
+                self.ready = True
+            else:
+                self.ircconn.part(channelname, 'not my channel', sendnow=False)
+                self.ircconn.join(self.cfg.channel, sendnow=False)
+                self.flush()
+        elif line["cmd"] == "PART" and line["nick"] == self.cfg.username:
+            channelname = line['dest'] or line['msg']
+            logger.info('I left IRC channel: %s' % channelname)
+        elif line["cmd"] == "PRIVMSG":
+            # ignored users
+            if self.cfg.ignored_user and re.match(self.cfg.ignored_user, line["nick"]):
+                return
+            if line["dest"] == self.cfg.username:
+                mtype = 'private'
+                src = dest = self._make_user(line["nick"])
+            elif line["dest"] == self.cfg.channel:
+                mtype = 'group'
+                src = self._make_user(line["nick"])
+                dest = self.dest
+            else:
+                return
+            # should use /whois and cache to get realname?
+            protocol = 'irc'
+            action = re_ircaction.match(line["msg"])
+            if action:
+                text = action.group(1).strip()
+                media = {'action': True}
+            else:
+                text = line["msg"].strip()
+                media = None
+            # OrzTox bot have actions and quotes
+            for p, val in self.proxies.items():
+                n, m = val
+                if n.match(line["nick"]):
+                    mt = m.match(text)
+                    if mt:
+                        protocol = p
+                        src = self._make_user(mt.group(1), p)
+                        text = mt.group(2)
+                    break
+            alttext = self.identify_mention(re_ircfmt.sub('', text))
+            self.bus.post(Message(
+                None, protocol, None, src, dest, text, media, mtime,
+                None, None, None, mtype, None if alttext == text else alttext
+            ), received)
+
     def send(self, response: Response, protocol: str, forwarded: Message) -> Message:
         # sending to proxies is not supported
         if protocol != 'irc':
@@ -361,4 +488,11 @@ class IRCProtocol(Protocol):
     def close(self):
         if self.run:
             self.run = False
-            self.ircconn.quit('SIGINT received')
+            if self.writer is not None:
+                # streams are not thread-safe, quit in their loop
+                if self.loop.is_running():
+                    self.loop.call_soon_threadsafe(self._quit_async)
+                elif not self.loop.is_closed():
+                    self._quit_async()
+            elif self.ircconn:
+                self.ircconn.quit('SIGINT received')
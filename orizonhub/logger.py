@@ -2,12 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import copy
+import glob
 import json
+import mmap
+import time
+import zlib
+import fcntl
+import bisect
+import struct
+import random
 import queue
 import sqlite3
 import logging
+import itertools
 import threading
+import contextlib
 import collections
+import collections.abc
+import urllib.request
 from datetime import datetime, timezone
 from logging.handlers import WatchedFileHandler
 
@@ -16,6 +30,51 @@ from .model import Message, User, Logger
 
 logger = logging.getLogger('logger')
 
+re_cjk = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af'
+                    '\uf900-\ufaff\U00020000-\U0002fa1f]+)')
+re_mention = re.compile(r'@(\w+)')
+
+# result codes of backup steps, not exported before Python 3.11
+SQLITE_BUSY = getattr(sqlite3, 'SQLITE_BUSY', 5)
+SQLITE_LOCKED = getattr(sqlite3, 'SQLITE_LOCKED', 6)
+
+def backfill_mentions(cur):
+    # replies, in the same protocol as the old /mention query
+    cur.execute('INSERT OR IGNORE INTO mentions (user_id, message_id, time, src) '
+        'SELECT r.src, m.id, m.time, m.src FROM messages m JOIN messages r '
+        'ON r.protocol = m.protocol AND r.pid = m.reply_id '
+        'WHERE m.reply_id IS NOT NULL AND r.src != m.src')
+    usernames = collections.defaultdict(list)
+    for uid, username in cur.execute("SELECT id, username FROM users "
+                                     "WHERE username != ''").fetchall():
+        usernames[username.lower()].append(uid)
+    rows = []
+    for mid, src, text, mtime in cur.execute(
+        "SELECT id, src, text, time FROM messages WHERE text LIKE '%@%'"
+        ).fetchall():
+        for name in set(re_mention.findall(text)):
+            rows.extend((uid, mid, mtime, src) for uid in
+                        usernames.get(name.lower(), ()) if uid != src)
+    cur.executemany('INSERT OR IGNORE INTO mentions (user_id, message_id, '
+                    'time, src) VALUES (?,?,?,?)', rows)
+
+def fts_tokens(text, query=False):
+    '''
+    Prepare text for the bigram index: runs of CJK characters become
+    overlapping bigrams, the rest is left to the unicode61 tokenizer.
+    Indexed runs end with their last character alone, so that a prefix
+    query of one character finds it anywhere in a run.
+    '''
+    parts = re_cjk.split(text)
+    for k in range(1, len(parts), 2):
+        s = parts[k]
+        if len(s) > 1:
+            tokens = [s[i:i+2] for i in range(len(s) - 1)]
+            if not query:
+                tokens.append(s[-1])
+            parts[k] = ' '.join(tokens)
+    return ' '.join(parts)
+
 class TextLogger(Logger):
     '''Logs messages with plain text. Rotating-friendly.'''
     FORMAT = '%(asctime)s [%(protocol)s:%(pid)s] %(srcname)s >> %(text)s'
@@ -36,6 +95,143 @@ class TextLogger(Logger):
     def commit(self):
         pass
 
+# preset dictionary for compressed media, common strings last
+MEDIA_ZDICT = (
+    b'"mime_type":"audio/ogg""mime_type":"video/mp4""thumb":{"file_id":"'
+    b'"emoji":"""set_name":"""duration":"is_animated":false,'
+    b'"caption":"""forward_from_chat":{"id":"type":"channel","title":"'
+    b'"new_chat_participant":{"id":"first_name":"""username":"'
+    b'"sticker":{"file_id":"""document":{"file_id":"""file_name":"'
+    b'{"type":"mention","type":"url","type":"bot_command","type":"pre",'
+    b'"type":"code","type":"bold","type":"text_link","url":"'
+    b'"photo":[{"file_id":"","file_unique_id":"","file_size":'
+    b',"width":,"height":},{"file_id":"'
+    b'{"edit_date":"entities":[{"offset":0,"length":'
+)
+
+def encode_media(media, compress=False):
+    '''
+    Encode the media dict for the media column: compact JSON text, or
+    with `compress`, a format byte and JSON deflated with MEDIA_ZDICT.
+    '''
+    if not media:
+        return None
+    text = json.dumps(dict(media), separators=(',', ':'), ensure_ascii=False)
+    if not compress:
+        return text
+    c = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=MEDIA_ZDICT)
+    return b'\x01' + c.compress(text.encode('utf-8')) + c.flush()
+
+def decode_media(value):
+    if value is None:
+        return None
+    elif isinstance(value, str):
+        return json.loads(value)
+    elif value[:1] == b'\x01':
+        d = zlib.decompressobj(-15, zdict=MEDIA_ZDICT)
+        return json.loads((d.decompress(value[1:]) + d.flush()).decode('utf-8'))
+    raise ValueError('unknown media encoding: %r' % value[:1])
+
+class LazyMedia(collections.abc.Mapping):
+    '''
+    Read-only media of a stored message, decoded on first access.
+    '''
+    __slots__ = ('raw', 'data')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.data = None
+
+    def _load(self):
+        data = self.data
+        if data is None:
+            data = self.data = decode_media(self.raw)
+        return data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __repr__(self):
+        return repr(self._load())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._load(), memo)
+
+def ro_uri(filename):
+    return 'file:%s?mode=ro' % urllib.request.pathname2url(
+        os.path.abspath(filename))
+
+class ReadPool:
+    '''
+    Up to `size` read-only connections to a SQLite database in WAL mode,
+    which can read while the logger writes.
+    '''
+
+    def __init__(self, filename, size=4, setup=None):
+        self.uri = ro_uri(filename)
+        self.size = size
+        # called with each new connection, and again after `refresh`
+        self.setup = setup
+        self.generation = 0
+        # (connection, generation)
+        self.pool = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def refresh(self):
+        '''
+        Run `setup` again on each connection before its next use.
+        '''
+        with self.lock:
+            self.generation += 1
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn, gen = self.pool.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                new = self.created < self.size
+                if new:
+                    self.created += 1
+            if new:
+                gen = self.generation
+                try:
+                    conn = sqlite3.connect(self.uri, uri=True,
+                                           check_same_thread=False)
+                    if self.setup:
+                        self.setup(conn, True)
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                conn, gen = self.pool.get()
+        try:
+            if gen != self.generation:
+                gen = self.generation
+                if self.setup:
+                    self.setup(conn, True)
+            yield conn
+        finally:
+            self.pool.put((conn, gen))
+
+    def close(self):
+        while 1:
+            try:
+                self.pool.get_nowait()[0].close()
+            except queue.Empty:
+                break
+
 class SQLiteLogger(Logger):
     '''Logs messages with SQLite.'''
     SCHEMA = (
@@ -70,128 +266,927 @@ class SQLiteLogger(Logger):
         ')',
         'CREATE INDEX IF NOT EXISTS idx_messages ON messages (protocol, pid)'
     )
+    # message counts by (sender, chat) of every hour and day (UTC)
+    ROLLUPS = (('activity_hourly', 'hour', 3600),
+               ('activity_daily', 'day', 86400))
+    # {} is the source table
+    ROLLUP_REBUILD = tuple(
+        'INSERT INTO %s (%s, src, dest, count) SELECT time / %d, src, dest, '
+        'count(*) FROM {} GROUP BY time / %d, src, dest' %
+        (table, col, secs, secs) for table, col, secs in ROLLUPS)
+    # statements or functions(cursor) to upgrade to each schema version,
+    # kept in user_version
+    MIGRATIONS = (
+        # 1: time ranges, statistics by user and mentions
+        ('CREATE INDEX IF NOT EXISTS idx_messages_time ON messages (time)',
+         'CREATE INDEX IF NOT EXISTS idx_messages_src ON messages (src, time)',
+         'CREATE INDEX IF NOT EXISTS idx_messages_reply ON messages (reply_id)'),
+        # 2: activity rollups
+        ('CREATE TABLE IF NOT EXISTS activity_hourly ('
+            'hour INTEGER, src INTEGER, dest INTEGER, count INTEGER,'
+            'PRIMARY KEY (hour, src, dest)) WITHOUT ROWID',
+         'CREATE TABLE IF NOT EXISTS activity_daily ('
+            'day INTEGER, src INTEGER, dest INTEGER, count INTEGER,'
+            'PRIMARY KEY (day, src, dest)) WITHOUT ROWID') +
+        tuple(stmt.format('messages') for stmt in ROLLUP_REBUILD),
+        # 3: users mentioned or replied to by messages
+        ('CREATE TABLE IF NOT EXISTS mentions ('
+            'user_id INTEGER, message_id INTEGER, time INTEGER, src INTEGER,'
+            'PRIMARY KEY (user_id, time, message_id)) WITHOUT ROWID',
+         'CREATE INDEX IF NOT EXISTS idx_users_username '
+            'ON users (username COLLATE NOCASE)',
+         backfill_mentions),
+    )
+    # full-text indexes: (table, tokenizer, prepares text); contentless,
+    # rowid is messages.id. Trigrams match any substring of 3 or more
+    # characters, shorter keywords use CJK bigrams and word prefixes.
+    FTS_TABLES = (
+        ('messages_fts', 'trigram', None),
+        ('messages_bigram', 'unicode61', fts_tokens),
+    )
+    FTS_SCHEMA = ("CREATE VIRTUAL TABLE {}{} USING fts5("
+                  "text, content='', tokenize='{}')")
+    # old messages moved out by `archive`, {} is the schema name
+    ARCHIVE_SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS {}.messages ('
+            'id INTEGER PRIMARY KEY,'
+            'protocol TEXT NOT NULL,'
+            'pid INTEGER,'
+            'src INTEGER,'
+            'dest INTEGER,'
+            'text TEXT,'
+            'media TEXT,'
+            'time INTEGER,'
+            'fwd_src INTEGER,'
+            'fwd_time INTEGER,'
+            'reply_id INTEGER'
+        ')',
+        'CREATE INDEX IF NOT EXISTS {}.idx_messages ON messages (protocol, pid)',
+        'CREATE INDEX IF NOT EXISTS {}.idx_messages_time ON messages (time)'
+    )
 
-    def __init__(self, filename, tz=None, wal=True, autocommit=False):
+    def __init__(self, filename, tz=None, wal=True, autocommit=False,
+                 writer=False, batch_size=100, batch_time=500,
+                 queue_size=10000, fts=True, readers=4, msg_cache=1000,
+                 user_cache=20000, preload=1000, compress_media=False,
+                 archives=True):
         self.lock = threading.Lock()
         self.autocommit = autocommit
-        self.msg_cache = LRUCache(50)
-        self.user_cache = {}
+        self.compress_media = compress_media
+        self.fts = False
+        # archive databases, attached as archive0, archive1, ...
+        self.filename = filename
+        self.archives = []
+        if archives and filename != ':memory:':
+            self.archives = sorted(glob.glob(
+                glob.escape(os.path.splitext(filename)[0]) + '.archive-*.db'))
+        # schemas with messages, and those with a messages_fts table
+        self.schemas = ('main',)
+        self.fts_schemas = ()
+        # readers only see committed messages, so only use them when
+        # commits are frequent
+        self.pool = None
+        if (readers and wal and (writer or autocommit)
+            and filename != ':memory:'):
+            self.pool = ReadPool(filename, readers, self._attach)
+        # progress of `backup` and results of `maintain`
+        self.maint_status = {}
+        self.msg_cache = LRUCache(msg_cache)
+        # users by id, and stored users by _key()
+        self.user_cache = LRUCache(user_cache)
+        self.user_index = LRUCache(user_cache)
+        # changed users to write by id
+        self.user_updates = {}
         with self.lock:
             self.conn = sqlite3.connect(filename, check_same_thread=False)
             cur = self.conn.cursor()
+            # only takes effect in new databases, see `vacuum`
+            cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
             for c in self.SCHEMA:
                 cur.execute(c)
             self.conn.commit()
+            self._migrate(cur)
+            self.auto_vacuum = cur.execute('PRAGMA auto_vacuum').fetchone()[0]
             if wal:
                 cur.execute('PRAGMA journal_mode=WAL')
-            for row in cur.execute('SELECT * FROM users'):
+            self._attach(self.conn)
+            if fts:
+                self.fts = self._init_fts(cur)
+                self._attach(self.conn)
+            # senders of the last `preload` messages
+            for row in cur.execute('SELECT * FROM users WHERE id IN ('
+                'SELECT src FROM messages WHERE id > '
+                '(SELECT max(id) FROM messages) - ?)', (preload,)):
                 u = User._make(row)
-                self.user_cache[u.id] = self.user_cache[u._key()] = u
+                self.user_cache[u.id] = self.user_index[u._key()] = u
+        # group commit: one writer thread, flushed every `batch_size`
+        # messages or `batch_time` milliseconds; `log` blocks when
+        # `queue_size` messages are waiting
+        self.writer = writer
+        self.batch_size = batch_size
+        self.batch_time = batch_time / 1000
+        self.queue = queue.Queue(queue_size)
+        self.writer_thread = None
+        if writer:
+            self.writer_thread = threading.Thread(target=self._write_loop, name='sqlitewriter')
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
+
+    def _migrate(self, cur):
+        version = cur.execute('PRAGMA user_version').fetchone()[0]
+        if version > len(self.MIGRATIONS):
+            logger.warning('Database schema version %d is newer than %d.',
+                           version, len(self.MIGRATIONS))
+            return
+        elif version == len(self.MIGRATIONS):
+            return
+        for v in range(version, len(self.MIGRATIONS)):
+            logger.info('Migrating database schema to version %d...', v + 1)
+            cur.execute('BEGIN')
+            for stmt in self.MIGRATIONS[v]:
+                if isinstance(stmt, str):
+                    cur.execute(stmt)
+                else:
+                    stmt(cur)
+            cur.execute('PRAGMA user_version = %d' % (v + 1))
+            self.conn.commit()
+        # let the query planner know about the new indexes
+        cur.execute('ANALYZE')
+        self.conn.commit()
+
+    @staticmethod
+    def _max_attached(conn):
+        try:
+            return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        except AttributeError:
+            # Python < 3.11, the default limit
+            return 10
+
+    def _attach(self, conn, readonly=False):
+        '''
+        Attach the archives to `conn` and create the temporary view
+        all_messages of messages in all of them.
+        '''
+        if len(self.archives) > self._max_attached(conn):
+            raise RuntimeError('%d archives exceed the limit of %d attached '
+                'databases, merge some of them' % (
+                len(self.archives), self._max_attached(conn)))
+        schemas = ['main']
+        for k, path in enumerate(self.archives):
+            name = 'archive%d' % k
+            if not conn.execute('SELECT 1 FROM pragma_database_list '
+                                'WHERE name = ?', (name,)).fetchone():
+                try:
+                    conn.execute('ATTACH DATABASE ? AS ' + name,
+                                 (ro_uri(path) if readonly else path,))
+                except sqlite3.OperationalError as ex:
+                    raise RuntimeError('failed to attach archive %s: %s' %
+                                       (path, ex)) from ex
+            schemas.append(name)
+        self.schemas = tuple(schemas)
+        conn.execute('DROP VIEW IF EXISTS temp.all_messages')
+        conn.execute('CREATE TEMP VIEW all_messages AS ' + ' UNION ALL '.join(
+            'SELECT * FROM %s.messages' % name for name in schemas))
+        if self.fts:
+            self.fts_schemas = tuple(name for name in schemas if all(
+                tokenizer in self._fts_sql(conn, name, table)
+                for table, tokenizer, prepare in self.FTS_TABLES))
+
+    @staticmethod
+    def _fts_sql(conn, schema, table):
+        row = conn.execute("SELECT sql FROM %s.sqlite_master WHERE name=?"
+                           % schema, (table,)).fetchone()
+        return row[0] if row else ''
+
+    def _fts_write(self, cur, schema, rows, delete=False):
+        '''
+        Add (id, text) `rows` to the full-text indexes of `schema`, or
+        remove them; contentless tables need the indexed text to delete.
+        '''
+        for table, tokenizer, prepare in self.FTS_TABLES:
+            if delete:
+                sql = ("INSERT INTO %s.%s (%s, rowid, text) VALUES "
+                       "('delete',?,?)" % (schema, table, table))
+            else:
+                sql = 'INSERT INTO %s.%s (rowid, text) VALUES (?,?)' % (
+                      schema, table)
+            cur.executemany(sql, rows if prepare is None else
+                            ((mid, prepare(text)) for mid, text in rows))
+
+    def _init_fts(self, cur):
+        '''
+        Build the full-text indexes of each schema without them, and
+        rebuild those with the tokenizer of older versions.
+        '''
+        for schema in self.schemas:
+            for table, tokenizer, prepare in self.FTS_TABLES:
+                sql = self._fts_sql(self.conn, schema, table)
+                if tokenizer in sql:
+                    continue
+                # build the index of existing messages in one go
+                try:
+                    cur.execute('BEGIN')
+                    if sql:
+                        cur.execute('DROP TABLE %s.%s' % (schema, table))
+                    cur.execute(self.FTS_SCHEMA.format(
+                                schema + '.', table, tokenizer))
+                except sqlite3.OperationalError:
+                    self.conn.rollback()
+                    logger.warning('FTS5 with the %s tokenizer is not '
+                                   'available, search is not indexed.', tokenizer)
+                    return False
+                logger.info('Building the full-text index %s.%s...', schema, table)
+                cur.executemany('INSERT INTO %s.%s (rowid, text) VALUES (?,?)'
+                    % (schema, table), ((mid, prepare(text) if prepare else text)
+                    for mid, text in self.conn.execute(
+                    "SELECT id, text FROM %s.messages WHERE text != ''" % schema)))
+                self.conn.commit()
+                logger.info('Full-text index built.')
+        return True
 
     def log(self, msg: Message):
         assert msg.mtype == 'group'
+        if self.writer:
+            self.queue.put(msg)
+            return
         with self.lock:
             cur = self.conn.cursor()
+            self._insert((msg,), cur)
+            if self.autocommit:
+                self._flush_users(cur)
+                self.conn.commit()
+
+    def _insert(self, messages, cur):
+        rows = []
+        replied = []
+        for msg in messages:
             dest = self.update_user(msg.chat, cur).id
             src = self.update_user(msg.src, cur).id
             fwd_src = self.update_user(msg.fwd_src, cur).id if msg.fwd_src else None
-            try:
-                cur.execute('INSERT INTO messages (protocol, pid, src, dest, text, media, time, fwd_src, fwd_time, reply_id) VALUES (?,?,?,?,?, ?,?,?,?,?)', (msg.protocol, msg.pid, src, dest, msg.text, json.dumps(msg.media) if msg.media else None, msg.time, fwd_src, msg.fwd_time, msg.reply and msg.reply.pid))
-                self.msg_cache[cur.lastrowid] = msg
-            except sqlite3.IntegrityError:
-                #logger.warning('Conflict message: %s', nt_repr(msg))
-                pass
-            if self.autocommit:
+            replied.append(self.update_user(msg.reply.src, cur).id
+                           if msg.reply and msg.reply.src else None)
+            rows.append((msg.protocol, msg.pid, src, dest, msg.text, encode_media(msg.media, self.compress_media), msg.time, fwd_src, msg.fwd_time, msg.reply and msg.reply.pid))
+        try:
+            cur.executemany('INSERT INTO messages (protocol, pid, src, dest, text, media, time, fwd_src, fwd_time, reply_id) VALUES (?,?,?,?,?, ?,?,?,?,?)', rows)
+            # rowids in one statement are consecutive
+            lastid = cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+            firstid = lastid - len(messages) + 1
+            for k, msg in enumerate(messages, firstid):
+                self.msg_cache[k] = msg
+            if self.fts:
+                self._fts_write(cur, 'main', [(k, msg.text) for k, msg in
+                                enumerate(messages, firstid) if msg.text])
+            self._update_rollups(rows, cur)
+            self._update_mentions(rows, replied, firstid, cur)
+        except sqlite3.IntegrityError:
+            #logger.warning('Conflict message: %s', nt_repr(msg))
+            pass
+
+    def _update_mentions(self, rows, replied, firstid, cur):
+        mentions = []
+        for mid, row, reply_src in zip(itertools.count(firstid), rows, replied):
+            src, text, mtime = row[2], row[4], row[6]
+            users = set()
+            if reply_src:
+                users.add(reply_src)
+            for name in set(re_mention.findall(text or '')):
+                uids = set(uid for uid, in cur.execute('SELECT id FROM users '
+                    'WHERE username = ? COLLATE NOCASE', (name,)))
+                # renames not written yet
+                for uid, user in self.user_updates.items():
+                    if (user.username or '').lower() == name.lower():
+                        uids.add(uid)
+                    else:
+                        uids.discard(uid)
+                users.update(uids)
+            users.discard(src)
+            mentions.extend((uid, mid, mtime, src) for uid in users)
+        cur.executemany('INSERT OR IGNORE INTO mentions (user_id, message_id, '
+                        'time, src) VALUES (?,?,?,?)', mentions)
+
+    def mention(self, uid, offset=0, exclude=()):
+        '''
+        Returns the id of the `offset`-th latest message mentioning or
+        replying to user `uid`, not sent by users in `exclude`, or None.
+        '''
+        exclude = tuple(exclude)
+        with self.reader() as conn:
+            row = conn.execute('SELECT message_id FROM mentions WHERE '
+                'user_id = ? AND src NOT IN (%s) ORDER BY time DESC, '
+                'message_id DESC LIMIT 1 OFFSET ?' % ','.join('?' * len(exclude)),
+                (uid,) + exclude + (offset,)).fetchone()
+        return row and row[0]
+
+    def _update_rollups(self, rows, cur):
+        for table, col, secs in self.ROLLUPS:
+            counts = collections.Counter(
+                (row[6] // secs, row[2], row[3]) for row in rows)
+            cur.executemany('INSERT OR IGNORE INTO %s (%s, src, dest, count) '
+                'VALUES (?,?,?,0)' % (table, col), counts)
+            cur.executemany('UPDATE %s SET count = count + ? '
+                'WHERE %s = ? AND src = ? AND dest = ?' % (table, col),
+                ((v,) + k for k, v in counts.items()))
+
+    def rebuild_rollups(self):
+        '''
+        Recount the activity rollups from the messages table.
+        '''
+        self.flush()
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN')
+            for table, col, secs in self.ROLLUPS:
+                cur.execute('DELETE FROM ' + table)
+            for stmt in self.ROLLUP_REBUILD:
+                cur.execute(stmt.format('all_messages'))
+            self.conn.commit()
+
+    @staticmethod
+    def _period(t, period):
+        # returns the name, start and end of the period (UTC) containing `t`
+        d = datetime.fromtimestamp(t, timezone.utc)
+        if period == 'month':
+            start = datetime(d.year, d.month, 1, tzinfo=timezone.utc)
+            end = datetime(d.year + d.month // 12, d.month % 12 + 1, 1,
+                           tzinfo=timezone.utc)
+            name = start.strftime('%Y-%m')
+        elif period == 'year':
+            start = datetime(d.year, 1, 1, tzinfo=timezone.utc)
+            end = datetime(d.year + 1, 1, 1, tzinfo=timezone.utc)
+            name = start.strftime('%Y')
+        else:
+            raise ValueError('unknown period: ' + period)
+        return name, int(start.timestamp()), int(end.timestamp())
+
+    def archive(self, cutoff, period='year'):
+        '''
+        Move messages before `cutoff` (unix time) into archive databases,
+        one per `period` ('year' or 'month'). Returns the number of
+        messages moved. The newest message always stays, so that new
+        message ids keep increasing. SQLite attaches at most 10 databases
+        by default, so long histories need the 'year' period.
+        '''
+        self.flush()
+        moved = 0
+        base = os.path.splitext(self.filename)[0]
+        with self.lock:
+            cur = self.conn.cursor()
+            lastid = cur.execute('SELECT max(id) FROM messages').fetchone()[0]
+            while 1:
+                first = cur.execute('SELECT min(time) FROM messages WHERE '
+                    'time < ? AND id < ?', (cutoff, lastid)).fetchone()[0]
+                if first is None:
+                    break
+                name, start, end = self._period(first, period)
+                path = '%s.archive-%s.db' % (base, name)
+                if path not in self.archives:
+                    if len(self.archives) >= self._max_attached(self.conn):
+                        raise ValueError('cannot add %s: at most %d archives '
+                            'can be attached, use a longer period' % (
+                            path, self._max_attached(self.conn)))
+                    self.archives.append(path)
+                    self._attach(self.conn)
+                    if self.pool:
+                        self.pool.refresh()
+                schema = 'archive%d' % self.archives.index(path)
+                cond = ('FROM main.messages WHERE time >= ? AND time < ? '
+                        'AND id < ?')
+                args = (start, min(end, cutoff), lastid)
+                cur.execute('BEGIN')
+                for stmt in self.ARCHIVE_SCHEMA:
+                    cur.execute(stmt.format(schema))
+                cur.execute('INSERT INTO %s.messages SELECT * %s' % (schema, cond), args)
+                count = cur.rowcount
+                if self.fts:
+                    if schema not in self.fts_schemas:
+                        for table, tokenizer, prepare in self.FTS_TABLES:
+                            cur.execute(self.FTS_SCHEMA.format(
+                                        schema + '.', table, tokenizer))
+                        self.fts_schemas += (schema,)
+                    rows = self.conn.execute("SELECT id, text %s AND text != ''"
+                                             % cond, args).fetchall()
+                    self._fts_write(cur, schema, rows)
+                    self._fts_write(cur, 'main', rows, delete=True)
+                cur.execute('DELETE ' + cond, args)
                 self.conn.commit()
+                logger.info('Archived %d messages to %s.', count, path)
+                moved += count
+        return moved
 
-    def update_user(self, user: User, cur=None):
+    def compact_media(self, batch=10000):
         '''
-        Update user in database if necessary, returns a User with `id` set.
+        Re-encode stored media with the current encoding. Returns the
+        number of rows rewritten. Run VACUUM afterwards to reclaim space.
+        '''
+        self.flush()
+        count = 0
+        lastid = 0
+        while 1:
+            with self.lock:
+                cur = self.conn.cursor()
+                rows = cur.execute('SELECT id, media FROM messages WHERE id > ? '
+                    'AND media IS NOT NULL ORDER BY id LIMIT ?',
+                    (lastid, batch)).fetchall()
+                if not rows:
+                    break
+                lastid = rows[-1][0]
+                updates = []
+                for mid, media in rows:
+                    new = encode_media(decode_media(media), self.compress_media)
+                    if new != media:
+                        updates.append((new, mid))
+                cur.executemany('UPDATE messages SET media = ? WHERE id = ?', updates)
+                self.conn.commit()
+            count += len(updates)
+        logger.info('Re-encoded media of %d messages.', count)
+        return count
 
-        Consider these situations:
-                      In cache        Not in cache
-        Known ID       Check         Cache & Update
-        Unknown    Get ID & Check   Check, Update/New
+    def backup(self, filename, pages=256, pause=0.05):
+        '''
+        Copy the main database to `filename` while logging goes on, with
+        SQLite's backup API. Copies `pages` pages per step and releases
+        the lock for `pause` seconds between steps. Archives are not
+        included; they do not change after they are written.
         '''
-        def _get_user_id(user):
-            if user.pid:
-                res = cur.execute('SELECT id FROM users WHERE protocol=? AND type=? AND pid=?', (user.protocol, int(user.type), user.pid)).fetchone()
+        self.flush()
+        tmpname = filename + '.tmp'
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        target = sqlite3.connect(tmpname)
+        status = self.maint_status['backup'] = {
+            'filename': filename, 'started': time.time(), 'finished': None,
+            'remaining': None, 'total': None, 'steps': 0, 'retries': 0,
+            'max_step': 0}
+        last = [time.monotonic(), 0]
+
+        def progress(st, remaining, total):
+            took = time.monotonic() - last[0]
+            if st in (SQLITE_BUSY, SQLITE_LOCKED):
+                # nothing was copied, the step is retried
+                status['retries'] += 1
             else:
-                res = cur.execute('SELECT id FROM users WHERE protocol=? AND type=? AND pid=? AND username=?', (user.protocol, int(user.type), 0, user.username or '')).fetchone()
-            if res:
-                return res[0]
+                status.update(remaining=remaining, total=total,
+                              steps=status['steps'] + 1,
+                              max_step=max(status['max_step'], took))
+                logger.debug('Backup step: %d/%d pages left, %.3fs.',
+                             remaining, total, took)
+                done = (total - remaining) * 10 // total if total else 10
+                if done > last[1]:
+                    last[1] = done
+                    logger.info('Backup: %d%% (%d/%d pages).', done * 10,
+                                total - remaining, total)
+            # let the logger in; changes made through self.conn are
+            # copied to the backup as well
+            self.lock.release()
+            try:
+                time.sleep(pause)
+            finally:
+                self.lock.acquire()
+                # a step can't run while self.conn has a write transaction
+                # open, which log() leaves until the next commit
+                self.conn.commit()
+                last[0] = time.monotonic()
 
-        def _update_user(uk, user):
-            cur.execute('UPDATE users SET protocol=?, username=?, first_name=?, last_name=?, alias=? WHERE id=?', (user.protocol, user.username or '', user.first_name, user.last_name, user.alias, user.id))
-            self.user_cache[user.id] = self.user_cache[uk] = user
+        try:
+            with self.lock:
+                self.conn.commit()
+                last[0] = time.monotonic()
+                self.conn.backup(target, pages=pages, progress=progress, sleep=0)
+            target.close()
+            os.replace(tmpname, filename)
+        except Exception:
+            target.close()
+            status['error'] = True
+            raise
+        finally:
+            status['finished'] = time.time()
+        logger.info('Backup to %s done in %d steps (%d retried), %.1fs '
+                    '(longest step %.3fs).', filename, status['steps'],
+                    status['retries'], status['finished'] - status['started'],
+                    status['max_step'])
+        return status
+
+    def maintain(self, stop=None, pages=256):
+        '''
+        Idle maintenance: incremental vacuum of `pages` free pages per step
+        until none are left, then a passive WAL checkpoint. Stops between
+        steps when `stop()` returns true.
+        '''
+        start = time.monotonic()
+        steps = []
+        freed = 0
+        with self.lock:
+            # may have been changed on another connection by the vacuum
+            # task; the setting is only reloaded when a read transaction
+            # starts, which freelist_count does
+            self.conn.commit()
+            self.conn.execute('PRAGMA freelist_count').fetchone()
+            self.auto_vacuum = self.conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        while self.auto_vacuum == 2 and not (stop and stop()):
+            t = time.monotonic()
+            with self.lock:
+                cur = self.conn.cursor()
+                free = cur.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free:
+                    break
+                self.conn.commit()
+                # execute() stops after the first page
+                cur.executescript('PRAGMA incremental_vacuum(%d)' % pages)
+                freed += free - cur.execute(
+                    'PRAGMA freelist_count').fetchone()[0]
+            steps.append(time.monotonic() - t)
+        checkpointed = None
+        if not (stop and stop()):
+            t = time.monotonic()
+            with self.lock:
+                self.conn.commit()
+                busy, frames, checkpointed = self.conn.execute(
+                    'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+            steps.append(time.monotonic() - t)
+        status = self.maint_status['maintain'] = {
+            'time': time.time(), 'freed': freed, 'checkpointed': checkpointed,
+            'steps': len(steps), 'max_step': max(steps, default=0),
+            'duration': time.monotonic() - start}
+        if freed or checkpointed:
+            logger.info('Maintenance: freed %d pages, checkpointed %s frames '
+                        'in %d steps (longest %.3fs).', freed, checkpointed,
+                        len(steps), status['max_step'])
+        return status
 
-        def _new_user(uk, user):
+    def vacuum(self):
+        '''
+        Rebuild the database with incremental auto-vacuum enabled, so that
+        `maintain` can free pages later. Blocks the logger while running.
+        '''
+        self.flush()
+        with self.lock:
+            self.conn.commit()
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.conn.execute('VACUUM')
+            self.auto_vacuum = self.conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+    def sample(self, start=None, end=None, tries=5):
+        '''
+        Returns the id of a random message with start <= time < end,
+        or None if there is none.
+
+        Ids are drawn uniformly between the first and the last message of
+        the window. Only exact hits are taken for a few tries before
+        seeking to the next message, so gaps hardly skew the result.
+        '''
+        cond, args = [], []
+        if start is not None:
+            cond.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            cond.append('time < ?')
+            args.append(end)
+        where = ' AND '.join(cond) or '1'
+        lo = hi = None
+        with self.reader() as conn:
+            # ordering by time on the view would sort the whole window
+            for schema in self.schemas:
+                first = conn.execute('SELECT id FROM %s.messages WHERE %s '
+                    'ORDER BY time, id LIMIT 1' % (schema, where), args).fetchone()
+                if first is None:
+                    continue
+                last = conn.execute('SELECT id FROM %s.messages WHERE %s '
+                    'ORDER BY time DESC, id DESC LIMIT 1' % (schema, where),
+                    args).fetchone()
+                lo = first[0] if lo is None else min(lo, first[0])
+                hi = last[0] if hi is None else max(hi, last[0])
+            if lo is None:
+                return None
+            for i in range(tries):
+                mid = random.randint(lo, hi)
+                if conn.execute('SELECT 1 FROM all_messages WHERE id = ? AND '
+                                + where, [mid] + args).fetchone():
+                    return mid
+            row = conn.execute('SELECT id FROM all_messages WHERE id BETWEEN '
+                '? AND ? AND %s ORDER BY id LIMIT 1' % where,
+                [mid, hi] + args).fetchone()
+        return row[0] if row else lo
+
+    def activity(self, start):
+        '''
+        Count messages by sender after `start` (unix time).
+        Returns [(src, count), ...].
+
+        Whole days and hours are read from the rollups, and the messages
+        before the first whole hour from the messages table.
+        '''
+        start = int(start)
+        hour = (start // 3600 + 1) * 3600
+        day = -(-hour // 86400) * 86400
+        today = int(time.time()) // 86400 * 86400
+        if day >= today:
+            parts = ('SELECT src, count FROM activity_hourly WHERE hour >= ?',)
+            args = (start, hour, hour // 3600)
+        else:
+            parts = ('SELECT src, count FROM activity_hourly '
+                     'WHERE hour >= ? AND hour < ?',
+                     'SELECT src, count FROM activity_daily '
+                     'WHERE day >= ? AND day < ?',
+                     'SELECT src, count FROM activity_hourly WHERE hour >= ?')
+            args = (start, hour, hour // 3600, day // 3600, day // 86400,
+                    today // 86400, today // 3600)
+        with self.reader() as conn:
+            return conn.execute('SELECT src, sum(count) FROM (SELECT src, 1 '
+                'AS count FROM all_messages WHERE time > ? AND time < ? UNION ALL '
+                + ' UNION ALL '.join(parts) + ') GROUP BY src', args).fetchall()
+
+    def _write_loop(self):
+        batch = []
+        barriers = []
+        deadline = None
+        while 1:
+            timeout = max(deadline - time.monotonic(), 0) if batch else None
             try:
-                cur.execute('INSERT INTO users (protocol, type, pid, username, first_name, last_name, alias) VALUES (?,?,?,?,?,?,?)', (user.protocol, user.type, user.pid or 0, user.username or '', user.first_name, user.last_name, user.alias))
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if isinstance(item, threading.Event):
+                barriers.append(item)
+            elif item:
+                batch.append(item)
+                if len(batch) == 1:
+                    deadline = time.monotonic() + self.batch_time
+            if (item is None or barriers or len(batch) >= self.batch_size
+                or batch and time.monotonic() >= deadline):
+                if batch:
+                    try:
+                        self._write_batch(batch)
+                    except Exception:
+                        logger.exception('Failed to write %d messages, '
+                                         'retrying one by one.', len(batch))
+                        for msg in batch:
+                            try:
+                                self._write_batch((msg,))
+                            except Exception:
+                                logger.exception('Failed to write message: %s',
+                                                 nt_repr(msg))
+                    batch = []
+                for ev in barriers:
+                    ev.set()
+                barriers = []
+            if item is None:
+                break
+
+    def _write_batch(self, batch):
+        with self.lock:
+            updates = self.user_updates.copy()
+            try:
+                cur = self.conn.cursor()
+                self._insert(batch, cur)
+                self._flush_users(cur)
                 self.conn.commit()
-                uid = cur.lastrowid
-            except sqlite3.IntegrityError:
-                logger.warning('Conflict user: %s', user)
-                uid = _get_user_id(user)
-                assert uid
-            self.user_cache[uid] = self.user_cache[uk] = User(uid, *user[1:])
-            return self.user_cache[uid]
+            except Exception:
+                self.conn.rollback()
+                # forget users and messages of the rolled back transaction
+                self.user_updates = updates
+                self.user_cache.clear()
+                self.user_index.clear()
+                self.msg_cache.clear()
+                raise
 
-        uk = user._key()
-        cached = self.user_cache.get(uk)
-        ret = user
+    def flush(self):
+        '''
+        Wait until all queued messages are written.
+        '''
+        if self.writer_thread and self.writer_thread.is_alive():
+            ev = threading.Event()
+            self.queue.put(ev)
+            ev.wait()
 
-        if cur is None:
-            cur = self.conn.cursor()
+    def update_user(self, user: User, cur=None):
+        '''
+        Update user in database if necessary, returns a User with `id` set.
 
-        if user.id is None:
-            # Cache hit, check and update
-            if cached:
-                ret = User(cached.id, *user[1:])
-                if cached != ret:
-                    _update_user(uk, ret)
-            # Cache miss, get id or create new
-            else:
-                uid = _get_user_id(user)
-                if uid is None:
-                    ret = _new_user(uk, user)
-        elif cached != user:
-            _update_user(uk, user)
+        Users are resolved by `_key()` in `user_index`, so a repeat user
+        needs no query; misses are read by the unique index. New users are
+        inserted in the current transaction. Changed users are kept in
+        `user_updates` and written once when the logger commits.
+        '''
+        if cur is None:
+            with self.lock:
+                return self.update_user(user, self.conn.cursor())
+        uk = user._key()
+        stored = self.user_index.get(uk)
+        if stored is None:
+            # the lowest id wins for duplicates
+            res = cur.execute('SELECT * FROM users WHERE protocol=? AND type=? AND pid=? AND (pid != 0 OR username=?) ORDER BY id LIMIT 1', (user.protocol, int(user.type), user.pid or 0, user.username or '')).fetchone()
+            if res:
+                stored = User._make(res)
+                pending = self.user_updates.get(stored.id)
+                if pending:
+                    stored = pending._replace(pid=pending.pid or 0,
+                                              username=pending.username or '')
+                self.user_index[uk] = stored
+        if stored is None and user.id is None:
+            try:
+                cur.execute('INSERT INTO users (protocol, type, pid, username, first_name, last_name, alias) VALUES (?,?,?,?,?,?,?)', (user.protocol, int(user.type), user.pid or 0, user.username or '', user.first_name, user.last_name, user.alias))
+                ret = User(cur.lastrowid, *user[1:])
+                self.user_index[uk] = ret._replace(
+                    pid=ret.pid or 0, username=ret.username or '')
+                self.user_cache[ret.id] = ret
+                return ret
+            except sqlite3.IntegrityError:
+                # added by someone else
+                logger.warning('Conflict user: %s', user)
+                row = cur.execute('SELECT id FROM users WHERE protocol=? AND type=? AND pid=? AND (pid != 0 OR username=?)', (user.protocol, int(user.type), user.pid or 0, user.username or '')).fetchone()
+                ret = User(row[0], *user[1:])
+        elif user.id is None:
+            ret = User(stored.id, *user[1:])
+        else:
+            ret = user
+        # as stored in the users table
+        row = ret._replace(pid=ret.pid or 0, username=ret.username or '')
+        if row != stored:
+            self.user_index[uk] = row
+            self.user_cache[ret.id] = ret
+            # renames are coalesced until the next commit
+            self.user_updates[ret.id] = ret
         return ret
 
+    def _flush_users(self, cur):
+        # write changed users, called with the lock held before commits
+        if not self.user_updates:
+            return
+        updates, self.user_updates = self.user_updates, {}
+        cur.executemany('UPDATE users SET protocol=?, username=?, first_name=?, last_name=?, alias=? WHERE id=?', ((user.protocol, user.username or '', user.first_name, user.last_name, user.alias, user.id) for user in updates.values()))
+
+    @contextlib.contextmanager
+    def reader(self):
+        '''
+        Get a connection for queries. Use it only within the `with` block.
+        '''
+        if self.pool:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            with self.lock:
+                self._flush_users(self.conn.cursor())
+                yield self.conn
+
     def getuser(self, uid: int):
         try:
             return self.user_cache[uid]
         except KeyError:
-            cur = self.conn.cursor()
-            u = User._make(cur.execute('SELECT * FROM users WHERE id = ?',
-                           (uid,)).fetchone())
-            self.user_cache[u.id] = self.user_cache[u._key()] = u
+            u = self.user_updates.get(uid)
+            if u:
+                return u
+            with self.reader() as conn:
+                row = conn.execute('SELECT * FROM users WHERE id = ?',
+                                   (uid,)).fetchone()
+            if row is None and self.pool:
+                # created in a batch not committed yet
+                with self.lock:
+                    row = self.conn.execute('SELECT * FROM users WHERE id = ?',
+                                            (uid,)).fetchone()
+            u = User._make(row)
+            self.user_cache[u.id] = u
             return u
 
+    MSG_COLUMNS = ('id, protocol, pid, src, dest, text, media, time, '
+                   'fwd_src, fwd_time, reply_id')
+
+    def _make_msg(self, row, reply=None):
+        mid, protocol, pid, src, dest, text, media, time, fwd_src, fwd_time, reply_id = row
+        return Message(
+            mid, protocol, pid, self.getuser(src), self.getuser(dest), text,
+            media and LazyMedia(media), time, fwd_src and self.getuser(fwd_src),
+            fwd_time, reply, 'group', None
+        )
+
     def getmsg(self, mid: int):
         res = self.msg_cache.get(mid)
         if res:
             return res
-        cur = self.conn.cursor()
-        res = cur.execute('SELECT protocol, pid, src, dest, text, media, time, fwd_src, fwd_time, reply_id FROM messages WHERE id = ?', (mid,)).fetchone()
+        with self.reader() as conn:
+            res = conn.execute('SELECT %s FROM all_messages WHERE id = ?' %
+                               self.MSG_COLUMNS, (mid,)).fetchone()
         if res is None:
             return None
-        protocol, pid, src, dest, text, media, time, fwd_src, fwd_time, reply_id = res
-        msg = Message(
-            mid, protocol, pid, self.getuser(src), self.getuser(dest), text,
-            media and json.loads(media), time, fwd_src and self.getuser(fwd_src),
-            fwd_time, reply_id and self.getmsg(reply_id), 'group', None
-        )
+        reply_id = res[-1]
+        msg = self._make_msg(res, reply_id and self.getmsg(reply_id))
         self.msg_cache[mid] = msg
         return msg
 
+    def _select_in(self, conn, req, ids, chunk=500):
+        # req has one %s for the placeholders
+        ids = list(ids)
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i+chunk]
+            yield from conn.execute(req % ','.join('?' * len(part)), part)
+
+    def getmsgs(self, ids):
+        '''
+        Get messages by ids with batched queries, resolving one level of
+        replies. Returns a list in the order of `ids`, None if not found.
+        '''
+        ids = list(ids)
+        found = {}
+        for mid in ids:
+            msg = self.msg_cache.get(mid)
+            if msg:
+                found[mid] = msg
+        req = 'SELECT %s FROM all_messages WHERE id IN (%%s)' % self.MSG_COLUMNS
+        with self.reader() as conn:
+            rows = {row[0]: row for row in self._select_in(
+                    conn, req, set(ids).difference(found))}
+            reply_ids = set()
+            for row in rows.values():
+                reply_id = row[-1]
+                if reply_id and reply_id not in rows:
+                    msg = self.msg_cache.get(reply_id)
+                    if msg:
+                        found[reply_id] = msg
+                    else:
+                        reply_ids.add(reply_id)
+            reply_rows = {row[0]: row for row in
+                          self._select_in(conn, req, reply_ids)}
+            uids = set()
+            for row in itertools.chain(rows.values(), reply_rows.values()):
+                uids.update((row[3], row[4], row[8]))
+            uids = [uid for uid in uids
+                    if uid is not None and uid not in self.user_cache]
+            users = list(self._select_in(
+                conn, 'SELECT * FROM users WHERE id IN (%s)', uids))
+        for row in users:
+            u = User._make(row)
+            self.user_cache[u.id] = u
+        replies = {}
+        for mid, row in reply_rows.items():
+            # replies of replies are only taken from the cache
+            reply_id = row[-1]
+            reply = reply_id and (found.get(reply_id) or self.msg_cache.get(reply_id))
+            replies[mid] = self._make_msg(row, reply)
+            if reply or not reply_id:
+                self.msg_cache[mid] = replies[mid]
+        def build(mid, visiting):
+            # replied messages in `rows` are built first
+            if mid not in found:
+                row = rows[mid]
+                reply_id = row[-1]
+                if reply_id in rows and reply_id not in visiting:
+                    visiting.add(mid)
+                    reply = build(reply_id, visiting)
+                else:
+                    reply = reply_id and (
+                        found.get(reply_id) or replies.get(reply_id))
+                found[mid] = self.msg_cache[mid] = self._make_msg(row, reply)
+            return found[mid]
+        for mid in rows:
+            build(mid, set())
+        return [found.get(mid) for mid in ids]
+
+    def search(self, keyword, uid=None, limit=5, offset=0):
+        '''
+        Search messages containing `keyword`, sent by `uid` if given.
+        Keywords shorter than 3 characters match CJK text anywhere, and
+        other words by their beginning.
+        Returns [(id, src, text, time), ...], most recent first.
+        '''
+        tokens = fts_tokens(keyword, query=True).strip()
+        table = None
+        if self.fts and len(keyword) >= 3:
+            table, query = 'messages_fts', '"%s"' % keyword.replace('"', '""')
+        elif self.fts and re.search(r'\w', tokens):
+            # CJK bigrams, or the run's last character, and word prefixes
+            table, query = 'messages_bigram', '"%s"*' % tokens.replace('"', '""')
+        if table:
+            where = 'id IN (%s)' % ' UNION ALL '.join(
+                'SELECT rowid FROM %s.%s WHERE %s MATCH ?' % (name, table, table)
+                for name in self.fts_schemas)
+            args = (query,) * len(self.fts_schemas)
+        else:
+            # no index, or nothing but punctuation
+            where = 'text LIKE ?'
+            args = ('%' + keyword + '%',)
+        with self.reader() as conn:
+            if uid is None:
+                return conn.execute('SELECT id, src, text, time FROM all_messages '
+                    'WHERE ' + where + ' ORDER BY time DESC LIMIT ? OFFSET ?',
+                    args + (limit, offset)).fetchall()
+            else:
+                return conn.execute('SELECT id, src, text, time FROM all_messages '
+                    'WHERE src = ? AND ' + where +
+                    ' ORDER BY time DESC LIMIT ? OFFSET ?',
+                    (uid,) + args + (limit, offset)).fetchall()
+
+    def cache_status(self):
+        return {'messages': self.msg_cache.stats(),
+                'users': self.user_cache.stats(),
+                'user_index': self.user_index.stats()}
+
     def select(self, req, arg=None):
         cur = self.conn.cursor()
-        return cur.execute(req, arg)
+        return cur.execute(req, arg or ())
 
     def commit(self):
+        self.flush()
         with self.lock:
+            self._flush_users(self.conn.cursor())
             try:
                 self.conn.commit()
             except sqlite3.OperationalError:
@@ -200,42 +1195,493 @@ class SQLiteLogger(Logger):
         logger.debug('db committed.')
 
     def close(self):
+        if self.writer_thread:
+            self.queue.put(None)
+            self.writer_thread.join()
         self.commit()
+        if self.pool:
+            self.pool.close()
         self.conn.close()
 
+# segment record: crc32 of the rest, id, time, pid, src, dest, fwd_src,
+# fwd_time, reply_pid, reply (message id), lengths of protocol, text and
+# media, followed by them; 0 stands for None in the numeric fields
+SEG_RECORD = struct.Struct('<IQqqIIIqqQBII')
+
+def _seg_name(path, segno):
+    return os.path.join(path, '%08d.seg' % segno)
+
+def _seg_list(path):
+    return sorted(int(os.path.basename(f)[:-4]) for f in
+                  glob.glob(os.path.join(glob.escape(path), '*.seg')))
+
+def _seg_read(fd, offset):
+    '''
+    Read the record at `offset`. Returns (fields, body), or None if the
+    record is incomplete or corrupt.
+    '''
+    head = os.pread(fd, SEG_RECORD.size, offset)
+    if len(head) < SEG_RECORD.size:
+        return None
+    fields = SEG_RECORD.unpack(head)
+    size = sum(fields[-3:])
+    body = os.pread(fd, size, offset + SEG_RECORD.size)
+    if len(body) < size or zlib.crc32(head[4:] + body) != fields[0]:
+        return None
+    return fields, body
+
+def _seg_row(fields, body):
+    # (id, protocol, pid, src, dest, text, media, time, fwd_src, fwd_time,
+    #  reply_pid, reply) with media as stored by encode_media
+    (crc, mid, mtime, pid, src, dest, fwd_src, fwd_time, reply_pid, reply,
+     plen, tlen, mlen) = fields
+    media = body[plen+tlen:] or None
+    if media and media[:1] != b'\x01':
+        media = media.decode('utf-8')
+    return (mid, body[:plen].decode('utf-8'), pid or None, src, dest,
+            body[plen:plen+tlen].decode('utf-8'), media, mtime,
+            fwd_src or None, fwd_time or None, reply_pid or None, reply or None)
+
+def _seg_users(path):
+    # users.jsonl, the last line of an id wins;
+    # returns the users and the size of the complete lines
+    users = {}
+    size = 0
+    try:
+        with open(os.path.join(path, 'users.jsonl'), 'rb') as f:
+            for line in f:
+                try:
+                    u = User._make(json.loads(line.decode('utf-8')))
+                except (ValueError, TypeError):
+                    # cut off by a crash
+                    break
+                users[u.id] = u
+                size += len(line)
+    except FileNotFoundError:
+        pass
+    return users, size
+
+def export_segments(path, filename, batch=10000):
+    '''
+    Export the segment log in directory `path` to a new SQLite database
+    `filename`, keeping message and user ids. Only reads, so the log can
+    be in use. Returns the number of messages exported.
+    '''
+    if os.path.exists(filename):
+        raise ValueError(filename + ' already exists')
+    conn = sqlite3.connect(filename)
+    cur = conn.cursor()
+    for c in SQLiteLogger.SCHEMA:
+        cur.execute(c)
+    cur.executemany('INSERT INTO users VALUES (?,?,?,?,?,?,?,?)',
+                    _seg_users(path)[0].values())
+    count = 0
+    rows = []
+    for segno in _seg_list(path):
+        fd = os.open(_seg_name(path, segno), os.O_RDONLY)
+        try:
+            offset = 0
+            while 1:
+                r = _seg_read(fd, offset)
+                if r is None:
+                    break
+                rows.append(_seg_row(*r)[:11])
+                offset += SEG_RECORD.size + len(r[1])
+                if len(rows) >= batch:
+                    cur.executemany('INSERT INTO messages (id, protocol, pid, '
+                        'src, dest, text, media, time, fwd_src, fwd_time, '
+                        'reply_id) VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+                    count += len(rows)
+                    rows = []
+        finally:
+            os.close(fd)
+    cur.executemany('INSERT INTO messages (id, protocol, pid, src, dest, '
+        'text, media, time, fwd_src, fwd_time, reply_id) '
+        'VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+    count += len(rows)
+    conn.commit()
+    conn.close()
+    # the SQLite logger migrates the new database: indexes, rollups,
+    # mentions and the full-text index
+    SQLiteLogger(filename, archives=False).close()
+    logger.info('Exported %d messages to %s.', count, filename)
+    return count
+
+class SegmentLogger(Logger):
+    '''
+    Logs messages to append-only segment files in the directory `path`,
+    for bridges that only need lookups by id and time.
+
+    Records (SEG_RECORD) are appended to <n>.seg, and a new segment is
+    started after `segment_size` bytes. `index` is a memory-mapped array
+    of (segment + 1, offset) by message id, and `times` holds the running
+    maximum time of every `time_step`-th message. Users are appended to
+    users.jsonl. Files are synced on commit; after a crash, records after
+    the last indexed one are recovered by scanning the segment tail.
+    '''
+    INDEX = struct.Struct('<II')
+    INDEX_CHUNK = 65536
+    TIME = struct.Struct('<qQ')
+
+    def __init__(self, path, tz=None, segment_size=64*1048576, time_step=256,
+                 compress_media=False, msg_cache=1000, pid_cache=10000):
+        self.path = path
+        self.segment_size = segment_size
+        self.time_step = time_step
+        self.compress_media = compress_media
+        self.lock = threading.Lock()
+        self.msg_cache = LRUCache(msg_cache)
+        # message ids of recent (protocol, pid), to resolve replies
+        self.pids = LRUCache(pid_cache)
+        os.makedirs(path, exist_ok=True)
+        # one writer at a time
+        self.lockfile = open(os.path.join(path, 'lock'), 'w')
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lockfile.close()
+            raise RuntimeError('segment log is in use: ' + path)
+        self.users, size = _seg_users(path)
+        self.user_index = {u._key(): u for u in
+                           sorted(self.users.values(), reverse=True)}
+        self.next_uid = max(self.users, default=0) + 1
+        self.userfile = open(os.path.join(path, 'users.jsonl'), 'a', encoding='utf-8')
+        self.userfile.truncate(size)
+        self.index_fd = os.open(os.path.join(path, 'index'), os.O_RDWR | os.O_CREAT)
+        self.index = None
+        self._map_index(os.fstat(self.index_fd).st_size // self.INDEX.size)
+        self.readers = {}
+        self._recover()
+
+    def _map_index(self, entries):
+        entries = -(-max(entries, 1) // self.INDEX_CHUNK) * self.INDEX_CHUNK
+        if self.index is not None:
+            self.index.close()
+        if os.fstat(self.index_fd).st_size < entries * self.INDEX.size:
+            os.ftruncate(self.index_fd, entries * self.INDEX.size)
+        self.index = mmap.mmap(self.index_fd, entries * self.INDEX.size)
+        self.capacity = entries
+
+    def _locate(self, mid):
+        # (segment, offset) of message `mid`, or None
+        if not 0 < mid <= self.capacity:
+            return None
+        seg, offset = self.INDEX.unpack_from(self.index, (mid - 1) * self.INDEX.size)
+        if seg:
+            return seg - 1, offset
+
+    def _set_index(self, mid, segno, offset, mtime):
+        if mid > self.capacity:
+            self._map_index(mid)
+        self.INDEX.pack_into(self.index, (mid - 1) * self.INDEX.size,
+                             segno + 1, offset)
+        self.maxtime = max(self.maxtime, mtime)
+        if mid % self.time_step == 0 and (not self.times or self.times[-1][1] < mid):
+            self.times.append((self.maxtime, mid))
+            os.write(self.times_fd, self.TIME.pack(self.maxtime, mid))
+        self.lastid = mid
+
+    def _reader(self, segno):
+        fd = self.readers.get(segno)
+        if fd is None:
+            fd = self.readers[segno] = os.open(
+                _seg_name(self.path, segno), os.O_RDONLY)
+        return fd
+
+    def _recover(self):
+        # the last indexed message; ids are indexed in order
+        lo, hi = 0, self.capacity
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._locate(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        lastid = lo
+        # sparse time index, without entries past the index
+        with open(os.path.join(self.path, 'times'), 'a+b') as f:
+            f.seek(0)
+            data = f.read()
+        self.times = [t for t in self.TIME.iter_unpack(
+                      data[:len(data) - len(data) % self.TIME.size])
+                      if t[1] <= lastid]
+        self.times_fd = os.open(os.path.join(self.path, 'times'), os.O_RDWR)
+        os.ftruncate(self.times_fd, len(self.times) * self.TIME.size)
+        os.lseek(self.times_fd, 0, os.SEEK_END)
+        # rescan from the last time entry, so that maxtime is exact
+        segs = _seg_list(self.path) or [0]
+        self.lastid = 0
+        self.maxtime = -2**63
+        segno, offset = segs[0], 0
+        if self.times:
+            self.maxtime = self.times[-1][0]
+            segno, offset = self._locate(self.times[-1][1])
+        elif lastid:
+            segno, offset = self._locate(1)
+        recovered = 0
+        for segno in segs[segs.index(segno):]:
+            fd = os.open(_seg_name(self.path, segno), os.O_RDWR | os.O_CREAT)
+            while 1:
+                r = _seg_read(fd, offset)
+                if r is None:
+                    break
+                fields, body = r
+                if fields[1] > lastid:
+                    recovered += 1
+                self._set_index(fields[1], segno, offset, fields[2])
+                offset += SEG_RECORD.size + len(body)
+            if offset < os.fstat(fd).st_size:
+                logger.warning('Dropped a broken record in segment %d at %d.',
+                               segno, offset)
+                if segno == segs[-1]:
+                    os.ftruncate(fd, offset)
+            if segno != segs[-1]:
+                os.close(fd)
+                offset = 0
+        if recovered:
+            logger.info('Recovered %d messages from the segment log.', recovered)
+        # entries written out before their records were
+        for mid in range(self.lastid + 1, min(lastid, self.capacity) + 1):
+            self.INDEX.pack_into(self.index, (mid - 1) * self.INDEX.size, 0, 0)
+        self.segno = segno
+        self.segpos = offset
+        self.fd = fd
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        # pids of the latest messages
+        for mid in range(max(self.lastid - self.pids.capacity, 0) + 1,
+                         self.lastid + 1):
+            segno, offset = self._locate(mid)
+            row = _seg_row(*_seg_read(self._reader(segno), offset))
+            if row[2]:
+                self.pids[row[1], row[2]] = mid
+
+    def update_user(self, user: User):
+        '''
+        Record the user if new or changed, returns a User with `id` set.
+        '''
+        with self.lock:
+            return self._update_user(user)
+
+    def _update_user(self, user):
+        uk = user._key()
+        stored = self.user_index.get(uk)
+        if user.id is not None:
+            ret = user
+        elif stored is not None:
+            ret = User(stored.id, *user[1:])
+        else:
+            ret = User(self.next_uid, *user[1:])
+        self.next_uid = max(self.next_uid, ret.id + 1)
+        row = ret._replace(type=int(ret.type), pid=ret.pid or 0,
+                           username=ret.username or '')
+        if row != stored:
+            self.user_index[uk] = self.users[ret.id] = row
+            self.userfile.write(json.dumps(row, ensure_ascii=False) + '\n')
+        return ret
+
+    def log(self, msg: Message):
+        assert msg.mtype == 'group'
+        with self.lock:
+            src = self._update_user(msg.src).id
+            dest = self._update_user(msg.chat).id
+            fwd_src = self._update_user(msg.fwd_src).id if msg.fwd_src else 0
+            reply_pid = msg.reply and msg.reply.pid or 0
+            reply = reply_pid and self.pids.get((msg.protocol, reply_pid)) or 0
+            protocol = msg.protocol.encode('utf-8')
+            text = (msg.text or '').encode('utf-8')
+            media = encode_media(msg.media, self.compress_media) or b''
+            if isinstance(media, str):
+                media = media.encode('utf-8')
+            mid = self.lastid + 1
+            body = SEG_RECORD.pack(0, mid, msg.time, msg.pid or 0, src, dest,
+                fwd_src, msg.fwd_time or 0, reply_pid, reply, len(protocol),
+                len(text), len(media))[4:] + protocol + text + media
+            record = struct.pack('<I', zlib.crc32(body)) + body
+            if self.segpos and self.segpos + len(record) > self.segment_size:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.segno += 1
+                self.segpos = 0
+                self.fd = os.open(_seg_name(self.path, self.segno),
+                                  os.O_RDWR | os.O_CREAT)
+            os.write(self.fd, record)
+            self._set_index(mid, self.segno, self.segpos, msg.time)
+            self.segpos += len(record)
+            if msg.pid:
+                self.pids[msg.protocol, msg.pid] = mid
+            self.msg_cache[mid] = msg._replace(id=mid)
+
+    def getuser(self, uid: int):
+        return self.users.get(uid)
+
+    def getmsg(self, mid: int):
+        res = self.msg_cache.get(mid)
+        if res:
+            return res
+        with self.lock:
+            loc = self._locate(mid) if mid <= self.lastid else None
+            r = loc and _seg_read(self._reader(loc[0]), loc[1])
+        if not r:
+            return None
+        (mid, protocol, pid, src, dest, text, media, mtime, fwd_src,
+         fwd_time, reply_pid, reply) = _seg_row(*r)
+        msg = Message(
+            mid, protocol, pid, self.getuser(src), self.getuser(dest), text,
+            media and LazyMedia(media), mtime, fwd_src and self.getuser(fwd_src),
+            fwd_time, reply and self.getmsg(reply), 'group', None
+        )
+        self.msg_cache[mid] = msg
+        return msg
+
+    def find_time(self, t):
+        '''
+        Returns the id of the first message with time >= `t` (unix time),
+        or None if there is none.
+        '''
+        with self.lock:
+            k = bisect.bisect_left(self.times, (t, 0))
+            mid = self.times[k - 1][1] + 1 if k else 1
+            lastid = self.lastid
+        while mid <= lastid:
+            msg = self.getmsg(mid)
+            if msg and msg.time >= t:
+                return mid
+            mid += 1
+        return None
+
+    def export_sqlite(self, filename):
+        '''
+        Export all messages to a new SQLite database, see export_segments.
+        '''
+        self.commit()
+        return export_segments(self.path, filename)
+
+    def commit(self):
+        with self.lock:
+            self.userfile.flush()
+            os.fsync(self.userfile.fileno())
+            os.fsync(self.fd)
+            self.index.flush()
+            os.fsync(self.times_fd)
+        logger.debug('segment log committed.')
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            for fd in self.readers.values():
+                os.close(fd)
+            self.readers.clear()
+            os.close(self.fd)
+            os.close(self.times_fd)
+            self.index.close()
+            os.close(self.index_fd)
+            self.userfile.close()
+            self.lockfile.close()
+
 class BasicStateStore(collections.UserDict):
+    '''
+    Key-value state in a JSON file. Keys set or deleted since the last
+    commit are tracked, and an unchanged store is not written. Values
+    should be assigned again after changes, not modified in place.
+
+    `save` appends hot keys to the side file `hotfile`, which is read
+    back on start and emptied once the store is committed.
+    '''
     def __init__(self, filename):
         if os.path.isfile(filename):
             data = json.load(open(filename, 'r', encoding='utf-8'))
         else:
             data = {}
-        super().__init__(data)
         self.filename = filename
+        self._init(data, filename + '.hot')
+
+    def _init(self, data, hotfile):
+        self.lock = threading.Lock()
+        self.dirty = set()
+        super().__init__()
+        self.data = data
+        self.hot_fd = None
+        if hotfile:
+            self.hot_fd = os.open(hotfile, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+            with open(self.hot_fd, 'rb', closefd=False) as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # cut off by a crash
+                        break
+                    self.data[key] = value
+                    self.dirty.add(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.dirty.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+            self.dirty.add(key)
+
+    def save(self, key, value):
+        '''
+        Set `key` and persist it now by appending one line to the side
+        file, for hot keys like tgapi.offset.
+        '''
+        with self.lock:
+            self.data[key] = value
+            self.dirty.add(key)
+            if self.hot_fd is not None:
+                os.write(self.hot_fd, json.dumps([key, value]).encode('utf-8') + b'\n')
+
+    def _write(self):
+        # write a new file and rename it, so a crash leaves either
+        # the old or the new state
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self.filename)
 
     def commit(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, sort_keys=True, indent=4)
+        with self.lock:
+            if not self.dirty:
+                return
+            self._write()
+            self.dirty.clear()
+            if self.hot_fd is not None:
+                os.ftruncate(self.hot_fd, 0)
 
     def close(self):
         self.commit()
+        if self.hot_fd is not None:
+            os.close(self.hot_fd)
+            self.hot_fd = None
 
 class SQLiteStateStore(BasicStateStore):
-    def __init__(self, connection, lock):
+    '''
+    Key-value state in the `state` table, sharing the connection and lock
+    (`db_lock`) of the SQLite logger. Only changed keys are written, when
+    the store is committed; `save` uses the side file `hotfile` if given.
+    '''
+    def __init__(self, connection, lock, hotfile=None):
         self.conn = connection
-        self.lock = lock
-        with self.lock:
+        self.db_lock = lock
+        with self.db_lock:
             cur = self.conn.cursor()
             cur.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
             self.conn.commit()
             data = {k: json.loads(v) for k,v in cur.execute('SELECT key, value FROM state')}
-        super(BasicStateStore, self).__init__(data)
+        self._init(data, hotfile)
 
-    def commit(self):
-        with self.lock:
+    def _write(self):
+        with self.db_lock:
             cur = self.conn.cursor()
-            for k, v in self.data.items():
-                cur.execute('REPLACE INTO state (key, value) VALUES (?,?)', (k, json.dumps(v)))
+            for key in self.dirty:
+                if key in self.data:
+                    cur.execute('REPLACE INTO state (key, value) VALUES (?,?)',
+                                (key, json.dumps(self.data[key])))
+                else:
+                    cur.execute('DELETE FROM state WHERE key = ?', (key,))
             self.conn.commit()
-
-    def close(self):
-        self.commit()
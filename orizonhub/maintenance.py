@@ -4,10 +4,12 @@
 import re
 import copy
 import json
+import time
 import logging
 
 from . import provider
 from .ext import logfmt
+from .logger import export_segments
 from .utils import nt_from_dict
 from .model import Message, User, UserType, Response
 
@@ -87,9 +89,21 @@ def _msg_dedup(messages):
         queue = queue_new
     yield from queue
 
+def _sqlite_logger(config, defaults=None, **kwargs):
+    '''
+    Open the SQLite logger in the config, with `defaults` for options the
+    config doesn't set and `kwargs` overriding it.
+    '''
+    cfg = config.loggers.sqlite
+    if not isinstance(cfg, dict):
+        cfg = {'filename': cfg}
+    cfg = dict(defaults or {}, **cfg)
+    cfg.update(kwargs)
+    return provider.loggers['sqlite'](**cfg)
+
 def import_to_db(dbs, config, sort=False):
-    sqlitelogger = provider.loggers['sqlite'](config.loggers.sqlite)
-    sqlitelogger.autocommit = False
+    sqlitelogger = _sqlite_logger(config, {'batch_size': 1000},
+                                  autocommit=False, writer=True)
     messages = []
     for dbtask in dbs:
         dbtask = dbtask.copy()
@@ -110,6 +124,36 @@ def import_to_db(dbs, config, sort=False):
             sqlitelogger.log(msg)
     sqlitelogger.close()
 
+def rebuild_rollups(config):
+    sqlitelogger = _sqlite_logger(config)
+    sqlitelogger.rebuild_rollups()
+    sqlitelogger.close()
+
+def compact_media(config):
+    sqlitelogger = _sqlite_logger(config)
+    sqlitelogger.compact_media()
+    sqlitelogger.close()
+
+def archive_messages(config, days=365, period='year'):
+    sqlitelogger = _sqlite_logger(config)
+    sqlitelogger.archive(time.time() - days * 86400, period)
+    sqlitelogger.close()
+
+def backup(config, filename, pages=256, pause=0.05):
+    sqlitelogger = _sqlite_logger(config)
+    sqlitelogger.backup(filename, pages, pause)
+    sqlitelogger.close()
+
+def vacuum(config):
+    sqlitelogger = _sqlite_logger(config)
+    sqlitelogger.vacuum()
+    sqlitelogger.close()
+
+def export_seglog(config, filename):
+    kwargs = config.loggers.seglog
+    path = kwargs['path'] if isinstance(kwargs, dict) else kwargs
+    export_segments(path, filename)
+
 def _import_chatdig(filename, group, config, exportdb=None, fromtime=None, totime=None):
     irc_dest = User(None, 'irc', UserType.group, None, config.protocols.irc.channel,
                     config.protocols.irc.channel, None, config.group_name)
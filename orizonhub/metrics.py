@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-memory latency histograms for the message path.
+'''
+
+import time
+import bisect
+import logging
+import threading
+import collections
+
+logger = logging.getLogger('metrics')
+
+# bucket upper bounds in seconds: 0.1ms .. ~65s, sqrt(2) apart
+BUCKETS = tuple(1e-4 * 2**(i/2) for i in range(40))
+
+# points on the message path, in order
+POINTS = (
+    'posted',      # protocol received -> MessageBus.post
+    'logged',      # post -> logger done
+    'forward_submitted',  # post -> forward submitted to the lane
+    'forwarded',   # post -> Protocol.forward returned
+    'responded',   # post -> respond sent
+)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last one is for overflow
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket containing the p-th percentile.
+        '''
+        with self.lock:
+            if not self.count:
+                return 0
+            rank = self.count * p / 100
+            acc = 0
+            for i, c in enumerate(self.counts):
+                acc += c
+                if acc >= rank and c:
+                    if i < len(self.buckets):
+                        return min(self.buckets[i], self.max)
+                    return self.max
+            return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+class Trace:
+    '''
+    Timestamps of one message on its way through the bus.
+    '''
+    __slots__ = ('metrics', 'start')
+
+    def __init__(self, metrics, received=None):
+        self.metrics = metrics
+        self.start = time.monotonic()
+        if received is not None:
+            metrics.observe('posted', self.start - received)
+
+    def mark(self, point):
+        self.metrics.observe(point, time.monotonic() - self.start)
+
+    def wrap(self, point, fn):
+        '''
+        Returns a function that marks `point` after calling `fn`.
+        '''
+        def wrapper(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.mark(point)
+        return wrapper
+
+class Metrics:
+    def __init__(self, log_interval=None):
+        self.histograms = collections.OrderedDict((p, Histogram()) for p in POINTS)
+        self.lock = threading.Lock()
+        self.log_interval = log_interval
+        self.last_dump = time.monotonic()
+
+    def trace(self, received=None):
+        return Trace(self, received)
+
+    def observe(self, point, value):
+        h = self.histograms.get(point)
+        if h is None:
+            with self.lock:
+                h = self.histograms.setdefault(point, Histogram())
+        h.observe(value)
+        if self.log_interval:
+            self._maybe_dump()
+
+    def _maybe_dump(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_dump < self.log_interval:
+                return
+            self.last_dump = now
+        for line in self.format():
+            logger.info(line)
+
+    def summary(self):
+        with self.lock:
+            items = tuple(self.histograms.items())
+        return collections.OrderedDict((k, h.summary()) for k, h in items)
+
+    def format(self):
+        return ['%s: %d, avg %.1fms, p50 %.1fms, p99 %.1fms, max %.1fms' % (
+            k, v['count'], v['avg']*1000, v['p50']*1000, v['p99']*1000,
+            v['max']*1000) for k, v in self.summary().items() if v['count']]
@@ -101,6 +101,9 @@ class Logger:
     def commit(self):
         pass
 
+    def maintain(self, stop=None):
+        pass
+
     def close(self):
         pass
 
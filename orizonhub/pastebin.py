@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import glob
 import time
 import hashlib
 import urllib.parse
@@ -15,11 +16,14 @@ def retrieve(url, filename, raisestatus=True):
     r = requests.get(url, stream=True)
     if raisestatus:
         r.raise_for_status()
-    with open(filename, 'wb') as f:
+    # files are served while others are still downloading
+    tmpname = filename + '.part'
+    with open(tmpname, 'wb') as f:
         for chunk in r.iter_content(chunk_size=1024):
             if chunk: # filter out keep-alive new chunks
                 f.write(chunk)
         f.flush()
+    os.replace(tmpname, filename)
     return r.status_code
 
 class BasePasteBin:
@@ -33,6 +37,13 @@ class BasePasteBin:
     def geturl(self, filename):
         raise NotImplementedError
 
+    def url_for(self, filename):
+        '''
+        The URL `filename` will have once pasted, or None if it is only
+        known after pasting.
+        '''
+        return None
+
     def getpath(self, filename):
         fpath = os.path.join(self.cachepath, filename)
         if os.path.isfile(fpath):
@@ -62,7 +73,7 @@ class BasePasteBin:
         if not self.exists(filename, size):
             retrieve(url, fpath)
         if os.path.getsize(fpath) > self.maxsize:
-            self.remove(self, filename)
+            self.remove(filename)
             raise ValueError("file size exceeds maxsize")
         return self.geturl(filename)
 
@@ -71,6 +82,17 @@ class BasePasteBin:
         return (os.path.isfile(fpath) and
                 (size is None or os.path.getsize(fpath) == size))
 
+    def find(self, stem, size=None):
+        '''
+        Name of a cached file called `stem` with any extension, or None.
+        '''
+        pattern = os.path.join(glob.escape(self.cachepath), glob.escape(stem))
+        for fpath in glob.glob(pattern) + glob.glob(pattern + '.*'):
+            filename = os.path.basename(fpath)
+            if not filename.endswith('.part') and self.exists(filename, size):
+                return filename
+        return None
+
     def remove(self, filename):
         try:
             os.unlink(os.path.join(self.cachepath, filename))
@@ -99,6 +121,9 @@ class DummyPasteBin(BasePasteBin):
     def exists(self, filename, size=None):
         return False
 
+    def find(self, stem, size=None):
+        return None
+
     def remove(self, filename):
         pass
 
@@ -115,8 +140,10 @@ class SimplePasteBin(BasePasteBin):
         fpath = os.path.join(self.cachepath, filename)
         if not os.path.isfile(fpath):
             raise FileNotFoundError(fpath)
-        url = os.path.join(self.baseurl, urllib.parse.quote(filename))
-        return url
+        return self.url_for(filename)
+
+    def url_for(self, filename):
+        return os.path.join(self.baseurl, urllib.parse.quote(filename))
 
     def close(self):
         for f in os.listdir(self.cachepath):
@@ -7,10 +7,11 @@ from .rawsocket import RawSocketProtocol
 from .telegrambot import TelegramBotProtocol
 from .telegramcli import TelegramCliProtocol
 from .pastebin import DummyPasteBin, SimplePasteBin, Elimage
-from .logger import Logger, TextLogger, SQLiteLogger, BasicStateStore, SQLiteStateStore
+from .logger import Logger, TextLogger, SQLiteLogger, SegmentLogger, BasicStateStore, SQLiteStateStore
 
 loggers = {
 'sqlite': SQLiteLogger,
+'seglog': SegmentLogger,
 'textlog': TextLogger,
 'dummylog': Logger
 }
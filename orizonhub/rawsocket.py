@@ -4,7 +4,11 @@
 import os
 import io
 import json
+import time
+import struct
+import asyncio
 import collections
+import collections.abc
 import socketserver
 from multiprocessing.connection import Connection
 
@@ -20,6 +24,8 @@ class RawSocketProtocol(Protocol):
     < {"ret": false, "response": null}
     > {"type": "get_updates", "offset": <int>}
     < {"ret": true, "offset": <int>, "messages": [{<Message>}]}
+    > {"type": "stats"}
+    < {"ret": true, "latency": {<point>: {<summary>}}, "pipeline": {...}}
     '''
 
     def __init__(self, config, bus):
@@ -28,15 +34,55 @@ class RawSocketProtocol(Protocol):
         self.pastebin = bus.pastebin
         self.handlers = []
         self.sockhdl = _request_handler(self.handlers, bus)
-        address = config.protocols.socket.address
-        if type(address) == tuple:
-            self.sockserv = socketserver.TCPServer(address, self.sockhdl)
-        elif type(address) is str:
-            self.sockserv = socketserver.UnixStreamServer(address, self.sockhdl)
+        self.address = config.protocols.socket.address
+        self.sockserv = None
+        self.aioserv = None
 
     def start_polling(self):
+        if type(self.address) == tuple:
+            self.sockserv = socketserver.TCPServer(self.address, self.sockhdl)
+        elif type(self.address) is str:
+            self.sockserv = socketserver.UnixStreamServer(self.address, self.sockhdl)
         self.sockserv.serve_forever()
 
+    async def start_async(self):
+        '''
+        Serve the same protocol with asyncio streams.
+        '''
+        if type(self.address) == tuple:
+            self.aioserv = await asyncio.start_server(self._handle_async, *self.address)
+        elif type(self.address) is str:
+            self.aioserv = await asyncio.start_unix_server(self._handle_async, self.address)
+        async with self.aioserv:
+            await self.aioserv.serve_forever()
+
+    async def _handle_async(self, reader, writer):
+        handler = _AsyncConnection(reader, writer)
+        self.handlers.append(handler)
+        try:
+            while 1:
+                try:
+                    obj = json.loads((await handler.recv_bytes()).decode('utf-8'))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                received = time.monotonic()
+                if obj['type'] == 'message':
+                    self.bus.post(nt_from_dict(Message, obj['message'], None), received)
+                    handler.send_bytes(json.dumps({'ret': True}).encode('utf-8'))
+                elif obj['type'] == 'request':
+                    m = await asyncio.wrap_future(self.bus.handler(
+                        nt_from_dict(Message, obj['message'], None), False))
+                    if m:
+                        ret = {"ret": True, "response": m._asdict()}
+                    else:
+                        ret = {"ret": False, "response": None}
+                    handler.send_bytes(json.dumps(ret, default=_json_default).encode('utf-8'))
+                elif obj['type'] == 'stats':
+                    handler.send_bytes(json.dumps(_stats(self.bus)).encode('utf-8'))
+        finally:
+            self.handlers.remove(handler)
+            handler.close()
+
     def send(self, response, protocol, forwarded):
         for h in self.handlers:
             h.send(response)
@@ -49,13 +95,61 @@ class RawSocketProtocol(Protocol):
         try:
             for h in self.handlers:
                 h.close()
-            self.sockserv.shutdown()
+            if self.sockserv:
+                self.sockserv.shutdown()
+            if self.aioserv:
+                self.aioserv.close()
         finally:
             try:
                 os.unlink(self.config.protocols.socket.address)
             except Exception:
                 pass
 
+def _json_default(obj):
+    # media of stored messages
+    if isinstance(obj, collections.abc.Mapping):
+        return dict(obj)
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+def _stats(bus):
+    return {"ret": True, "latency": bus.handler.metrics.summary(),
+            "pipeline": bus.handler.pipeline_status()}
+
+class _AsyncConnection:
+    '''
+    multiprocessing.connection compatible framing over asyncio streams.
+    `send` and `send_bytes` can be called from any thread.
+    '''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_event_loop()
+
+    async def recv_bytes(self):
+        size, = struct.unpack('!i', await self.reader.readexactly(4))
+        if size == -1:
+            size, = struct.unpack('!Q', await self.reader.readexactly(8))
+        return await self.reader.readexactly(size)
+
+    def send_bytes(self, buf):
+        n = len(buf)
+        if n > 0x7fffffff:
+            header = struct.pack('!i', -1) + struct.pack('!Q', n)
+        else:
+            header = struct.pack('!i', n)
+        self.loop.call_soon_threadsafe(self.writer.write, header + buf)
+
+    def send(self, msg):
+        if isinstance(msg, Message):
+            ret = {"type": "message", "message": msg._asdict()}
+        else:
+            ret = {"type": "response", "response": msg._asdict()}
+        self.send_bytes(json.dumps(ret, default=_json_default).encode('utf-8'))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
 def _request_handler(registry, bus):
     class RawSocketHandler(socketserver.BaseRequestHandler):
         def setup(self):
@@ -68,8 +162,9 @@ def _request_handler(registry, bus):
                     obj = json.loads(self.conn.recv_bytes().decode('utf-8'))
                 except EOFError:
                     break
+                received = time.monotonic()
                 if obj['type'] == 'message':
-                    bus.post(nt_from_dict(Message, obj['message'], None))
+                    bus.post(nt_from_dict(Message, obj['message'], None), received)
                     self.conn.send_bytes(json.dumps({'ret': True}).encode('utf-8'))
                 elif obj['type'] == 'request':
                     m = bus.post_sync(nt_from_dict(Message, obj['message'], None))
@@ -77,14 +172,16 @@ def _request_handler(registry, bus):
                         ret = {"ret": True, "response": m._asdict()}
                     else:
                         ret = {"ret": False, "response": None}
-                    self.conn.send_bytes(json.dumps(ret).encode('utf-8'))
+                    self.conn.send_bytes(json.dumps(ret, default=_json_default).encode('utf-8'))
+                elif obj['type'] == 'stats':
+                    self.conn.send_bytes(json.dumps(_stats(bus)).encode('utf-8'))
 
         def send(self, msg):
             if isinstance(msg, Message):
                 ret = {"type": "message", "message": msg._asdict()}
             else:
                 ret = {"type": "response", "response": msg._asdict()}
-            self.conn.send_bytes(json.dumps(ret).encode('utf-8'))
+            self.conn.send_bytes(json.dumps(ret, default=_json_default).encode('utf-8'))
 
         def finish(self):
             registry.remove(self)
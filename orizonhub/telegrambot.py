@@ -5,7 +5,12 @@ import os
 import re
 import json
 import time
+import asyncio
 import logging
+import functools
+import mimetypes
+import threading
+import concurrent.futures
 
 from .model import __version__, Protocol, Message, User, UserType, Response
 from .utils import mdescape, timestring_a, smartname, fwd_to_text, sededit, LimitedSizeDict
@@ -114,15 +119,14 @@ class TelegramBotProtocol(Protocol):
         self.dest = User(None, 'telegram', UserType.group, self.cfg.groupid,
                          None, config.group_name, None, config.group_name)
         self.msghistory = LimitedSizeDict(size_limit=10)
+        # media files are mirrored in the background
+        self.media_pool = concurrent.futures.ThreadPoolExecutor(
+            self.cfg.get('media_workers', 4), 'tgmedia')
+        self.media_pending = set()
+        self.media_lock = threading.Lock()
 
     def start_polling(self):
-        self.identity = self._make_user(self.bot_api('getMe'))
-        self.cfg.username = self.identity.username
-        # reload usernames
-        self.bus.handler.usernames = set(p.username for p in
-            self.bus.handler.config.protocols.values() if 'username' in p)
-        if 'sqlite' in self.bus.handler.loggers:
-            self.identity = self.bus.sqlite.update_user(self.identity)
+        self._prepare()
         while self.run:
             logger.debug('tgapi.offset: %s',
                 self.bus.handler.state.get('tgapi.offset', 0))
@@ -132,26 +136,61 @@ class TelegramBotProtocol(Protocol):
             except Exception:
                 logging.exception('TelegramBot: Get updates failed.')
                 continue
-            if updates:
-                logging.debug('TelegramBot: %r.', updates)
-                maxupd = 0
-                for upd in updates:
-                    maxupd = max(maxupd, upd['update_id'])
-                    if 'message' in upd:
-                        msg = self._make_message(upd['message'], True)
-                    elif 'edited_message' in upd:
-                        msg = self._make_message(upd['edited_message'], True)
-                    else:
-                        continue
-                    # ignore users in forwarding
-                    if (self.cfg.get('ignored_user') and
-                        msg.mtype == 'group' and
-                        msg.src.pid in self.cfg.ignored_user):
-                        continue
-                    self.bus.post(msg)
-                self.bus.handler.state['tgapi.offset'] = maxupd + 1
+            self._process_updates(updates)
             time.sleep(.2)
 
+    async def start_async(self):
+        '''
+        Coroutine version of start_polling for the asyncio runtime.
+        Blocking API calls run in the default executor of the loop.
+        '''
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._prepare)
+        while self.run:
+            logger.debug('tgapi.offset: %s',
+                self.bus.handler.state.get('tgapi.offset', 0))
+            try:
+                updates = await loop.run_in_executor(None, functools.partial(
+                    self.bot_api, 'getUpdates',
+                    offset=self.bus.handler.state.get('tgapi.offset', 0), timeout=10))
+            except Exception:
+                logging.exception('TelegramBot: Get updates failed.')
+                continue
+            # making messages may fetch media
+            await loop.run_in_executor(None, self._process_updates, updates)
+            await asyncio.sleep(.2)
+
+    def _prepare(self):
+        self.identity = self._make_user(self.bot_api('getMe'))
+        self.cfg.username = self.identity.username
+        # reload usernames
+        self.bus.handler.usernames = set(p.username for p in
+            self.bus.handler.config.protocols.values() if 'username' in p)
+        if 'sqlite' in self.bus.handler.loggers:
+            self.identity = self.bus.sqlite.update_user(self.identity)
+
+    def _process_updates(self, updates):
+        if not updates:
+            return
+        logging.debug('TelegramBot: %r.', updates)
+        received = time.monotonic()
+        maxupd = 0
+        for upd in updates:
+            maxupd = max(maxupd, upd['update_id'])
+            if 'message' in upd:
+                msg = self._make_message(upd['message'], True)
+            elif 'edited_message' in upd:
+                msg = self._make_message(upd['edited_message'], True)
+            else:
+                continue
+            # ignore users in forwarding
+            if (self.cfg.get('ignored_user') and
+                msg.mtype == 'group' and
+                msg.src.pid in self.cfg.ignored_user):
+                continue
+            self.bus.post(msg, received)
+        self.bus.handler.state.save('tgapi.offset', maxupd + 1)
+
     def send(self, response: Response, protocol: str, forwarded: Message) -> Message:
         rinfo = response.info or {}
         kwargs = rinfo.get('telegrambot', {})
@@ -238,6 +277,7 @@ class TelegramBotProtocol(Protocol):
 
     def close(self):
         self.run = False
+        self.media_pool.shutdown(wait=False)
 
     def bot_api(self, method, input_file=None, **params):
         wait = self.rate - time.perf_counter() + self.last_sent
@@ -285,35 +325,84 @@ class TelegramBotProtocol(Protocol):
         else:
             raise AttributeError
 
-    def _parse_media(self, media):
+    @staticmethod
+    def _media_file(media):
+        '''
+        Returns (file_id, cache file name, file size) of the file in media,
+        or None. Does not call the API.
+        '''
         mt = media.keys() & frozenset(('audio', 'document', 'sticker', 'video', 'voice'))
-        file_ext = ''
         if mt:
             mt = mt.pop()
-            file_id = media[mt]['file_id']
-            file_size = media[mt].get('file_size')
+            fval = media[mt]
+            file_ext = os.path.splitext(fval.get('file_name', ''))[1]
             if mt == 'sticker':
-                file_ext = '.webp'
+                file_ext = ('.tgs' if fval.get('is_animated') else
+                            '.webm' if fval.get('is_video') else '.webp')
+            elif not file_ext and fval.get('mime_type'):
+                file_ext = mimetypes.guess_extension(fval['mime_type']) or ''
         elif 'photo' in media:
-            photo = max(media['photo'], key=lambda x: x['width'])
-            file_id = photo['file_id']
-            file_size = photo.get('file_size')
+            fval = max(media['photo'], key=lambda x: x['width'])
             file_ext = '.jpg'
         else:
             return None
+        return (fval['file_id'], fval['file_id'] + file_ext, fval.get('file_size'))
+
+    def _get_file(self, file_id):
+        # download URL and size
         logging.debug('getFile: %r' % file_id)
+        fp = self.bot_api('getFile', file_id=file_id)
+        file_path = fp.get('file_path')
+        if not file_path:
+            raise BotAPIFailed("can't get file_path for " + file_id)
+        return self.url_file + file_path, fp.get('file_size')
+
+    def _parse_media(self, media):
+        f = self._media_file(media)
+        if f is None:
+            return None
+        file_id, cachename, file_size = f
         if self.config.services.pastebin:
-            fp = self.bot_api('getFile', file_id=file_id)
-            file_size = fp.get('file_size') or file_size or 0
-            file_path = fp.get('file_path')
-            if not file_path:
-                raise BotAPIFailed("can't get file_path for " + file_id)
-            file_ext = os.path.splitext(file_path)[1] or file_ext
-            cachename = file_id + file_ext
-            return (self.url_file + file_path, cachename, file_size)
+            url, size = self._get_file(file_id)
+            return (url, cachename, size or file_size or 0)
         else:
             return ('', '', 0)
 
+    def _mirror_media(self, media):
+        '''
+        Link to the cached copy of the media file, which is downloaded by
+        `media_pool`. Pastebins that only know the URL after pasting are
+        served inline.
+        '''
+        f = self._media_file(media)
+        url = f and self.bus.pastebin.url_for(f[1])
+        if not url:
+            return self.bus.pastebin.paste_url(*self._parse_media(media))
+        file_id, cachename, file_size = f
+        if file_size and file_size > self.bus.pastebin.maxsize:
+            raise ValueError("file size exceeds maxsize")
+        with self.media_lock:
+            if (cachename in self.media_pending or
+                self.bus.pastebin.exists(cachename, file_size)):
+                return url
+            # older versions named the file after the getFile path
+            legacy = self.bus.pastebin.find(file_id, file_size)
+            if legacy:
+                return self.bus.pastebin.url_for(legacy)
+            self.media_pending.add(cachename)
+        self.media_pool.submit(self._fetch_media, file_id, cachename, file_size)
+        return url
+
+    def _fetch_media(self, file_id, cachename, file_size):
+        try:
+            url, size = self._get_file(file_id)
+            self.bus.pastebin.paste_url(url, cachename, size or file_size)
+        except Exception:
+            logging.exception("can't paste a file: %s", cachename)
+        finally:
+            with self.media_lock:
+                self.media_pending.discard(cachename)
+
     def servemedia(self, media):
         '''
         Reply type and link of media. This only generates links for photos.
@@ -346,7 +435,7 @@ class TelegramBotProtocol(Protocol):
             elif ftype == 'sticker' and fval.get('emoji'):
                 ret = fval['emoji'] + ' ' + ret
             try:
-                ret += ' ' + self.bus.pastebin.paste_url(*self._parse_media(media))
+                ret += ' ' + self._mirror_media(media)
             except (TypeError, NotImplementedError):
                 # _parse_media returned None
                 pass
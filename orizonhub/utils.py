@@ -6,6 +6,7 @@ import time
 import signal
 import difflib
 import datetime
+import threading
 import functools
 import collections
 
@@ -68,30 +69,52 @@ def wrap_attrdict(obj):
         return obj
 
 class LRUCache(collections.UserDict):
+    '''
+    Thread-safe LRU cache of at most `maxlen` items, counting hits, misses
+    and evictions.
+    '''
+
     def __init__(self, maxlen):
         self.capacity = maxlen
         self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
 
     def __getitem__(self, key):
-        value = self.data.pop(key)
-        self.data[key] = value
-        return value
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.data[key] = value
+            self.hits += 1
+            return value
 
     def get(self, key, default=None):
         try:
-            value = self.data.pop(key)
-            self.data[key] = value
-            return value
+            return self[key]
         except KeyError:
             return default
 
     def __setitem__(self, key, value):
-        try:
-            self.data.pop(key)
-        except KeyError:
-            if len(self.data) >= self.capacity:
-                self.data.popitem(last=False)
-        self.data[key] = value
+        with self.lock:
+            try:
+                self.data.pop(key)
+            except KeyError:
+                if len(self.data) >= self.capacity:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+            self.data[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {'size': len(self.data), 'maxsize': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
 
 class LimitedSizeDict(collections.OrderedDict):
     def __init__(self, *args, **kwds):
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Synthetic load benchmark for the message bus.
+
+Drives a mix of messages through MessageBus.post with stub protocols,
+a stub pastebin and a temporary SQLite database, then prints throughput
+and per-stage latency as JSON.
+
+    python3 tools/benchmark.py -n 5000 --mix text=70,command=10,edit=10,media=5,reply=5,bounce=2
+
+A 'bounce' is a recent message repeated by an IRC relay bot, as our own
+forward "[name] text"; all of them should be suppressed by the dedup index.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(__file__), '..')))
+
+from orizonhub import base, provider
+from orizonhub.model import __version__, Protocol, Message, User, UserType
+from orizonhub.pastebin import DummyPasteBin
+from orizonhub.utils import smartname
+
+DEFAULT_MIX = 'text=70,command=10,edit=10,media=5,reply=5,bounce=2'
+COMMANDS = ('/233 5', '/do shrug', '/stat', '/m 1', '/context 5 2')
+
+class StubPasteBin(DummyPasteBin):
+    def paste_text(self, text, filename=None):
+        return 'https://paste.example.com/' + str(hash(text))
+
+    def paste_data(self, data, filename=None):
+        return 'https://paste.example.com/' + str(hash(data))
+
+    def paste_url(self, url, filename, size=None):
+        return 'https://paste.example.com/' + filename
+
+class BotAPIFailed(Exception):
+    pass
+
+class StubProtocol(Protocol):
+    '''
+    Accepts everything after an optional delay, like a remote API call.
+    '''
+    BotAPIFailed = BotAPIFailed
+    def __init__(self, config, bus, name, delay=0):
+        super().__init__(config, bus)
+        self.name = name
+        self.delay = delay
+        self.identity = User(None, 'telegram' if name.startswith('telegram')
+                             else name, UserType.user, 1, 'benchbot',
+                             'Bench Bot', None, None)
+        self.dest = User(None, self.identity.protocol, UserType.group, -1,
+                         None, 'bench', None, None)
+        self.forward_enabled = True
+        self.forwarded = 0
+        self.sent = 0
+
+    def forward(self, msg, protocol):
+        if self.delay:
+            time.sleep(self.delay)
+        self.forwarded += 1
+        return Message(None, self.name, None, self.identity, self.dest,
+                       msg.text, None, int(time.time()), None, None, None,
+                       msg.mtype, None)
+
+    def bot_api(self, method, **params):
+        # commands fall back to text replies
+        raise BotAPIFailed(method)
+
+    def send(self, response, protocol, forwarded):
+        if self.delay:
+            time.sleep(self.delay)
+        self.sent += 1
+        return Message(None, self.name, None, self.identity, self.dest,
+                       response.text, None, int(time.time()), None, None,
+                       response.reply, response.reply.mtype, None)
+
+def parse_mix(s):
+    mix = {}
+    for item in s.split(','):
+        k, v = item.split('=')
+        mix[k.strip()] = float(v)
+    return mix
+
+class MessageFactory:
+    def __init__(self, mix, users=50, seed=0):
+        self.kinds = list(mix.keys())
+        self.weights = [mix[k] for k in self.kinds]
+        self.random = random.Random(seed)
+        self.chat = User(None, 'telegram', UserType.group, -1, None,
+                         'bench', None, None)
+        self.irc_chat = User(None, 'irc', UserType.group, None, '#bench',
+                             '#bench', None, None)
+        self.users = [User(None, 'telegram', UserType.user, 1000 + n,
+                      'user%d' % n, 'User %d' % n, None, None)
+                      for n in range(users)]
+        self.pid = 0
+        self.recent = []
+
+    def make(self):
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        now = int(time.time())
+        src = self.random.choice(self.users)
+        text = 'message %d %s' % (self.pid, 'lorem ipsum ' * self.random.randint(0, 8))
+        media = reply = None
+        pid = self.pid = self.pid + 1
+        if kind == 'command':
+            text = self.random.choice(COMMANDS)
+        elif kind == 'edit' and self.recent:
+            old = self.random.choice(self.recent)
+            pid, src = old.pid, old.src
+            media = {'edit_date': now}
+        elif kind == 'media':
+            media = {'photo': [{'file_id': 'AgAD%d' % pid, 'width': 800,
+                     'height': 600, 'file_size': 65536}]}
+            text = ''
+        elif kind == 'reply' and self.recent:
+            reply = self.random.choice(self.recent)
+        elif kind == 'bounce' and self.recent:
+            old = self.random.choice(self.recent)
+            relay = User(None, 'xmpp', UserType.user, None, 'benchbot',
+                         None, None, 'benchbot')
+            return kind, Message(None, 'xmpp', None, relay, self.irc_chat,
+                '[%s] %s' % (smartname(old.src), old.text), None, now,
+                None, None, None, 'group', None)
+        msg = Message(None, 'telegrambot', pid, src, self.chat, text, media,
+                      now, None, None, reply, 'group', None)
+        if kind == 'text':
+            self.recent.append(msg)
+            del self.recent[:-100]
+        return kind, msg
+
+def wait_idle(handler, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(st['qsize'] == 0 and st['submitted'] == st['done']
+               for st in handler.pipeline_status().values()):
+            return True
+        time.sleep(0.01)
+    return False
+
+def run(args):
+    # the database, status and media files are removed afterwards
+    with tempfile.TemporaryDirectory(prefix='orizonbench') as tmpdir:
+        return _run(args, tmpdir)
+
+def _run(args, tmpdir):
+    config = {
+        'debug': False,
+        'runtime': args.runtime,
+        'status': os.path.join(tmpdir, 'status.json'),
+        'bot_fullname': 'Bench Bot',
+        'bot_nickname': 'BenchBot',
+        'group_name': 'bench',
+        'timezone': 'UTC',
+        'command_config': {},
+        'loggers': {'sqlite': {'filename': os.path.join(tmpdir, 'chatlog.db'),
+                               'writer': args.writer}},
+        'main_protocol': 'telegrambot',
+        'protocols': {
+            'telegrambot': {'username': 'benchbot'},
+            'irc': {'username': 'benchbot', 'proxies': [
+                ('xmpp', '^OrzGTalk.*', r'\(GTalk\) (\w+): (.+)$')]},
+            'socket': {},
+        },
+        'forward': ['telegrambot', 'irc', 'socket'],
+        'services': {'pastebin': None},
+        'commit': {'idle': 1, 'min_interval': 1, 'max_delay': 5},
+    }
+    if args.runtime == 'asyncio':
+        from orizonhub import aio
+        bot = aio.AsyncBotInstance(config)
+        loopthread = threading.Thread(target=bot.loop.run_forever, name='loop')
+        loopthread.daemon = True
+        loopthread.start()
+    else:
+        bot = base.BotInstance(config)
+    bot.setup()
+    bot.bus.pastebin = StubPasteBin()
+    delays = parse_mix(args.delay) if args.delay else {}
+    for name in config['protocols']:
+        bot.protocols[name] = StubProtocol(
+            bot.config, bot.bus, name, delays.get(name, 0) / 1000)
+    provider.command.rebuild()
+    factory = MessageFactory(parse_mix(args.mix), args.users, args.seed)
+    counts = {}
+    futures = []
+    start = time.monotonic()
+    for n in range(args.messages):
+        kind, msg = factory.make()
+        counts[kind] = counts.get(kind, 0) + 1
+        futures.append(bot.bus.post(msg, time.monotonic()))
+    for fut in futures:
+        fut.result()
+    idle = wait_idle(bot.bus.handler)
+    for l in bot.loggers.values():
+        l.commit()
+    elapsed = time.monotonic() - start
+    result = {
+        'version': __version__,
+        'runtime': args.runtime,
+        'writer': args.writer,
+        'messages': args.messages,
+        'mix': counts,
+        'elapsed': elapsed,
+        'throughput': args.messages / elapsed,
+        'completed': idle,
+        'latency': bot.bus.handler.metrics.summary(),
+        'pipeline': bot.bus.handler.pipeline_status(),
+        'dedup': bot.bus.handler.dedup.status(),
+        'protocols': {k: {'forwarded': p.forwarded, 'sent': p.sent}
+                      for k, p in bot.protocols.items()},
+    }
+    if result['dedup']['suppressed'] < counts.get('bounce', 0):
+        logging.warning('Only %d of %d bounces were suppressed.',
+                        result['dedup']['suppressed'], counts['bounce'])
+    if args.runtime == 'asyncio':
+        bot.loop.call_soon_threadsafe(bot.loop.stop)
+        loopthread.join()
+    bot.exit()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Message bus load benchmark.')
+    parser.add_argument('-n', '--messages', type=int, default=2000, help='number of messages')
+    parser.add_argument('-m', '--mix', default=DEFAULT_MIX, help='message mix, kind=weight,... (kinds: text, command, edit, media, reply, bounce)')
+    parser.add_argument('-u', '--users', type=int, default=50, help='number of senders')
+    parser.add_argument('-d', '--delay', default='', help='protocol delays in ms, name=ms,...')
+    parser.add_argument('-r', '--runtime', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('-w', '--writer', action='store_true', help='use the SQLite writer thread')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write JSON result to this file')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s [%(levelname).1s:%(name).8s] %(message)s', level=logging.WARNING)
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+if __name__ == '__main__':
+    main()